@@ -0,0 +1,140 @@
+"""Utility to compare the CPU time the Discord alert handlers spend logging each alert's
+payload with log_payload(), with LOG_ALERT_PAYLOADS off and on, and with the pprint.pp()
+call it replaced."""
+
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import contextlib
+import os
+import pprint
+import statistics
+import sys
+import time
+
+
+def alert_payloads() -> list[tuple[str, object, tuple[str, ...]]]:
+    """A payload of each alert type the sample handles, with the fields its handler logs."""
+    from firebase_functions.alerts import app_distribution_fn, crashlytics_fn, performance_fn
+
+    crashlytics = crashlytics_fn.NewFatalIssuePayload(
+        issue=crashlytics_fn.Issue(
+            id="2b7e0ec47d2a0a5e2fd2bb6a0f28f8e3",
+            title="java.lang.NullPointerException",
+            subtitle="Attempt to invoke virtual method 'int java.lang.String.length()'"
+            " on a null object reference at com.example.app.MainActivity.onCreate"
+            " (MainActivity.java:42)",
+            app_version="2.4.1 (241)",
+        )
+    )
+    app_distribution = app_distribution_fn.NewTesterDevicePayload(
+        tester_name="Alex Tester",
+        tester_email="alex.tester@example.com",
+        tester_device_model_name="iPhone15,2",
+        tester_device_identifier="00008120-001A2D3E4F5A6B7C",
+    )
+    performance = performance_fn.ThresholdAlertPayload(
+        event_name="checkout_screen_load",
+        event_type="trace",
+        metric_type="duration",
+        num_samples=1200,
+        threshold_value=2.5,
+        threshold_unit="seconds",
+        violation_value=3.8,
+        violation_unit="seconds",
+        investigate_uri="https://console.firebase.google.com/project/demo/performance/app/"
+        "android:com.example.app/troubleshooting/trace/DURATION_TRACE/checkout_screen_load",
+        condition_percentile=90,
+        app_version="2.4.1 (241)",
+    )
+    return [
+        (
+            "Crashlytics",
+            crashlytics,
+            ("issue.id", "issue.title", "issue.subtitle", "issue.app_version"),
+        ),
+        (
+            "App Distribution",
+            app_distribution,
+            ("tester_device_model_name", "tester_device_identifier"),
+        ),
+        (
+            "Performance",
+            performance,
+            (
+                "event_name",
+                "event_type",
+                "metric_type",
+                "threshold_value",
+                "threshold_unit",
+                "violation_value",
+                "violation_unit",
+                "condition_percentile",
+                "app_version",
+            ),
+        ),
+    ]
+
+
+def time_calls(log, calls: int) -> list[float]:
+    """CPU time of each call, with what it writes to stdout and stderr discarded, as Cloud
+    Logging would collect it from the function's output."""
+    times = []
+    with open(os.devnull, "w") as devnull:
+        with contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull):
+            for _ in range(calls):
+                start = time.process_time()
+                log()
+                times.append(time.process_time() - start)
+    return times
+
+
+def summarize(times: list[float]) -> str:
+    p50, p99 = (statistics.quantiles(times, n=100)[i] for i in (49, 98))
+    return f"p50 {p50 * 1e6:7.1f} us, p99 {p99 * 1e6:7.1f} us"
+
+
+if __name__ == "__main__":
+    import argparse
+
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument(
+        "--calls", "-n", type=int, default=2000, help="number of payloads to log per mode"
+    )
+    argparser.add_argument(
+        "functions_dir",
+        nargs="?",
+        default="alerts-to-discord/functions",
+        help="the functions directory whose main.py to benchmark",
+    )
+    args = argparser.parse_args()
+
+    # The function decorators need a project config to import outside of the emulator.
+    os.environ.setdefault("FIREBASE_CONFIG", '{"projectId": "demo-alertlogbench"}')
+    os.environ.setdefault("GCLOUD_PROJECT", "demo-alertlogbench")
+    sys.path.insert(0, args.functions_dir)
+    import main
+
+    for alert, payload, fields in alert_payloads():
+        print(f"{alert} alert:")
+        os.environ["LOG_ALERT_PAYLOADS"] = "false"
+        modes = [
+            ("pprint.pp", lambda: pprint.pp(payload)),
+            ("log_payload off", lambda: main.log_payload("Payload", payload, fields)),
+        ]
+        for label, log in modes:
+            print(f"{label:>16}: {summarize(time_calls(log, args.calls))}")
+        os.environ["LOG_ALERT_PAYLOADS"] = "true"
+        times = time_calls(lambda: main.log_payload("Payload", payload, fields), args.calls)
+        print(f"{'log_payload on':>16}: {summarize(times)}")
@@ -12,17 +12,35 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import pprint
+import functools
 
 # [START v2import]
 from firebase_functions import params
 from firebase_functions.alerts import app_distribution_fn, crashlytics_fn, performance_fn
 # [END v2import]
 
+import firebase_admin
+from firebase_functions import logger, scheduler_fn
+
 import requests
 
+# Posts to the webhook over a kept-alive connection, with timeouts and retries.
+import webhook
+
 DISCORD_WEBHOOK_URL = params.SecretParam("DISCORD_WEBHOOK_URL")
 
+# Log the fields of each alert's payload listed in the handler, at debug severity. Off by
+# default, so handlers don't spend time formatting payloads nobody reads.
+LOG_ALERT_PAYLOADS = params.BoolParam("LOG_ALERT_PAYLOADS", default=False)
+# Longer payload field values are truncated to this many characters.
+PAYLOAD_FIELD_MAX_CHARS = 500
+
+# Queue alerts and post them together, instead of posting each one as it arrives. Repeats
+# of an alert that's still queued are counted instead of posted again.
+BATCH_ALERTS = params.BoolParam("BATCH_ALERTS", default=False)
+# Post queued alerts at least this often.
+ALERT_BATCH_WINDOW_MINUTES = params.IntParam("ALERT_BATCH_WINDOW_MINUTES", default=5)
+
 
 def post_message_to_discord(
     bot_name: str, message_body: str, webhook_url: str
@@ -40,9 +58,9 @@ def post_message_to_discord(
             "https://support.discord.com/hc/en-us/articles/228383668-Intro-to-Webhooks"
         )
 
-    return requests.post(
+    return webhook.post(
         url=webhook_url,
-        json={
+        payload={
             # Here's what the Discord API supports in the payload:
             # https://discord.com/developers/docs/resources/webhook#execute-webhook-jsonform-params
             "username": bot_name,
@@ -72,16 +90,24 @@ ID: `{issue.id}`
 """.strip()
     # [END v2CrashlyticsEventPayload]
 
+    if BATCH_ALERTS.value:
+        queue_alert(f"crashlytics-{app_id}-{issue.id}", "Crashlytics Bot", message)
+        return
+
     try:
         # [START v2SendToDiscord]
         response = post_message_to_discord("Crashlytics Bot", message, DISCORD_WEBHOOK_URL.value)
         if response.ok:
             print(f"Posted fatal Crashlytics alert {issue.id} for {app_id} to Discord.")
-            pprint.pp(event.data.payload)
+            log_payload(
+                "Crashlytics alert payload",
+                event.data.payload,
+                ("issue.id", "issue.title", "issue.subtitle", "issue.app_version"),
+            )
         else:
             response.raise_for_status()
         # [END v2SendToDiscord]
-    except (EnvironmentError, requests.HTTPError) as error:
+    except (EnvironmentError, requests.RequestException) as error:
         print(f"Unable to post fatal Crashlytics alert {issue.id} for {app_id} to Discord.", error)
 
 
@@ -101,16 +127,28 @@ UDID **{app_dist.tester_device_identifier}** for {app_dist.tester_device_model_n
 """.strip()
     # [END v2AppDistributionEventPayload]
 
+    if BATCH_ALERTS.value:
+        queue_alert(
+            f"appdistribution-{app_id}-{app_dist.tester_device_identifier}",
+            "App Distro Bot",
+            message,
+        )
+        return
+
     try:
         # [START v2SendNewTesterIosDeviceToDiscord]
         response = post_message_to_discord("App Distro Bot", message, DISCORD_WEBHOOK_URL.value)
         if response.ok:
             print(f"Posted iOS device registration alert for {app_dist.tester_email} to Discord.")
-            pprint.pp(event.data.payload)
+            log_payload(
+                "App Distribution alert payload",
+                event.data.payload,
+                ("tester_device_model_name", "tester_device_identifier"),
+            )
         else:
             response.raise_for_status()
         # [END v2SendNewTesterIosDeviceToDiscord]
-    except (EnvironmentError, requests.HTTPError) as error:
+    except (EnvironmentError, requests.RequestException) as error:
         print(
             f"Unable to post iOS device registration alert for {app_dist.tester_email} to Discord.",
             error,
@@ -141,6 +179,14 @@ Number of samples checked: {perf.num_samples}
 """.strip()
     # [END v2PerformanceEventPayload]
 
+    if BATCH_ALERTS.value:
+        queue_alert(
+            f"performance-{app_id}-{perf.event_type}-{perf.event_name}-{perf.metric_type}",
+            "App Performance Bot",
+            message,
+        )
+        return
+
     try:
         # [START v2SendPerformanceAlertToDiscord]
         response = post_message_to_discord(
@@ -148,10 +194,167 @@ Number of samples checked: {perf.num_samples}
         )
         if response.ok:
             print(f"Posted Firebase Performance alert {perf.event_name} to Discord.")
-            pprint.pp(event.data.payload)
+            log_payload(
+                "Performance alert payload",
+                event.data.payload,
+                (
+                    "event_name",
+                    "event_type",
+                    "metric_type",
+                    "threshold_value",
+                    "threshold_unit",
+                    "violation_value",
+                    "violation_unit",
+                    "num_samples",
+                    "app_version",
+                ),
+            )
         else:
             response.raise_for_status()
         # [END v2SendPerformanceAlertToDiscord]
-    except (EnvironmentError, requests.HTTPError) as error:
+    except (EnvironmentError, requests.RequestException) as error:
         print(f"Unable to post Firebase Performance alert {perf.event_name} to Discord.", error)
 # [END v2Alerts]
+
+
+def log_payload(message: str, payload: object, fields: tuple[str, ...]) -> None:
+    """Log some fields of an alert payload as a structured debug entry, if
+    LOG_ALERT_PAYLOADS is set.
+
+    Params:
+        fields: Attribute names on the payload. Nested attributes are separated by dots.
+            Fields that aren't listed, such as tester emails, aren't logged.
+    """
+    if not LOG_ALERT_PAYLOADS.value:
+        return
+    logged = {}
+    for field in fields:
+        value = payload
+        for name in field.split("."):
+            value = getattr(value, name, None)
+        if not isinstance(value, int | float | bool | type(None)):
+            value = str(value)[:PAYLOAD_FIELD_MAX_CHARS]
+        logged[field] = value
+    logger.debug(message, payload=logged)
+
+
+# Discord accepts at most 10 embeds in one message, and at most this many characters in
+# an embed's description.
+DISCORD_MAX_EMBEDS = 10
+DISCORD_MAX_DESCRIPTION = 4096
+
+# Queued alerts, keyed by what they're about, so repeats land on the same document.
+ALERT_QUEUE_COLLECTION = "discordAlertQueue"
+
+
+@functools.cache
+def get_app() -> firebase_admin.App:
+    """Initialize the Admin SDK on first use, then reuse it for the life of the instance."""
+    return firebase_admin.initialize_app()
+
+
+def queue_alert(key: str, bot_name: str, message: str) -> None:
+    """Queue an alert to post to Discord with the others.
+
+    Alerts with the same key are merged until they're posted, so a crash storm or a
+    flapping threshold posts one embed with a count. Once there are enough queued alerts
+    to fill a message, they're posted right away instead of waiting for
+    flushdiscordalerts.
+    """
+    from firebase_admin import firestore
+
+    db = firestore.client(app=get_app())
+    queue = db.collection(ALERT_QUEUE_COLLECTION)
+    queue.document(key.replace("/", "_")).set(
+        {
+            "botName": bot_name,
+            "message": message,
+            "count": firestore.Increment(1),
+            "updated": firestore.SERVER_TIMESTAMP,
+        },
+        merge=True,
+    )
+    print(f"Queued alert {key} for Discord.")
+
+    if len(queue.select([]).limit(DISCORD_MAX_EMBEDS).get()) >= DISCORD_MAX_EMBEDS:
+        post_queued_alerts(max_messages=1)
+
+
+@scheduler_fn.on_schedule(
+    schedule=f"every {max(ALERT_BATCH_WINDOW_MINUTES.value, 1)} minutes",
+    secrets=["DISCORD_WEBHOOK_URL"],
+)
+def flushdiscordalerts(event: scheduler_fn.ScheduledEvent) -> None:
+    """Posts the alerts queued since the last run to Discord, up to 10 per message."""
+    if BATCH_ALERTS.value:
+        post_queued_alerts()
+
+
+def post_queued_alerts(max_messages: int | None = None) -> None:
+    """Post queued alerts to Discord, oldest first, until the queue is empty.
+
+    Each batch is removed from the queue in a transaction before it's posted, so
+    concurrent flushes don't post the same alert twice. A batch that fails to post is
+    put back in the queue for the next flush.
+    """
+    from firebase_admin import firestore
+
+    db = firestore.client(app=get_app())
+    queue = db.collection(ALERT_QUEUE_COLLECTION)
+    query = queue.order_by("updated").limit(DISCORD_MAX_EMBEDS)
+
+    @firestore.transactional
+    def claim_batch(transaction) -> list:
+        snapshots = list(query.get(transaction=transaction))
+        for snapshot in snapshots:
+            transaction.delete(snapshot.reference)
+        return snapshots
+
+    messages = 0
+    while max_messages is None or messages < max_messages:
+        snapshots = claim_batch(db.transaction())
+        if not snapshots:
+            return
+        alerts = [snapshot.to_dict() for snapshot in snapshots]
+        embeds = []
+        for alert in alerts:
+            description = alert["message"]
+            if alert["count"] > 1:
+                description += f"\n\n_Repeated {alert['count']} times._"
+            embeds.append(
+                {
+                    "author": {"name": alert["botName"]},
+                    "description": description[:DISCORD_MAX_DESCRIPTION],
+                }
+            )
+        try:
+            response = post_embeds_to_discord(embeds, DISCORD_WEBHOOK_URL.value)
+            response.raise_for_status()
+        except (EnvironmentError, requests.RequestException) as error:
+            print(f"Unable to post {len(embeds)} queued alerts to Discord.", error)
+            batch = db.batch()
+            for snapshot, alert in zip(snapshots, alerts):
+                # Merge with any repeats that arrived while this batch was being posted.
+                batch.set(
+                    snapshot.reference,
+                    alert | {"count": firestore.Increment(alert["count"])},
+                    merge=True,
+                )
+            batch.commit()
+            return
+        print(f"Posted {len(embeds)} queued alerts to Discord.")
+        messages += 1
+
+
+def post_embeds_to_discord(embeds: list[dict], webhook_url: str) -> requests.Response:
+    """Posts up to 10 embeds to Discord in one message with Discord's Webhook API."""
+    if webhook_url == "":
+        raise EnvironmentError(
+            "No webhook URL found. Set the Discord Webhook URL before deploying. "
+            "Learn more about Discord webhooks here: "
+            "https://support.discord.com/hc/en-us/articles/228383668-Intro-to-Webhooks"
+        )
+
+    return webhook.post(
+        url=webhook_url, payload={"username": "Firebase Alerts Bot", "embeds": embeds}
+    )
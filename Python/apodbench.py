@@ -0,0 +1,149 @@
+"""Utility to compare the throughput and peak memory of backupapod's streaming image backup
+with downloading the whole image first, against a local stand-in for the image host."""
+
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import http.server
+import os
+import subprocess
+import sys
+import threading
+
+
+class StandInImageHost(http.server.BaseHTTPRequestHandler):
+    """Serves an image of a set size on a kept-alive connection, without holding it in
+    memory, so this process's peak RSS doesn't carry over to the backups it starts."""
+
+    protocol_version = "HTTP/1.1"
+    image_bytes = 0
+    chunk = os.urandom(64 * 1024)
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "image/jpeg")
+        self.send_header("Content-Length", str(self.image_bytes))
+        self.end_headers()
+        remaining = self.image_bytes
+        while remaining > 0:
+            self.wfile.write(self.chunk[:remaining])
+            remaining -= len(self.chunk)
+
+    def log_message(self, format, *args):
+        pass
+
+
+# Backs up the image in a fresh interpreter, so each mode starts from the same peak. The
+# bucket discards what's uploaded, so the numbers leave out the upload itself, and the one
+# UPLOAD_CHUNK_BYTES chunk a real resumable upload holds in memory.
+backup_runner = """
+import os, resource, sys, time
+sys.path.insert(0, sys.argv[1])
+import main
+
+url, mode, runs = sys.argv[2], sys.argv[3], int(sys.argv[4])
+
+class Blob:
+    def __init__(self, name, chunk_size=None):
+        self.name = name
+
+    def open(self, mode, content_type=None):
+        return open(os.devnull, "wb")
+
+    def upload_from_string(self, data, content_type=None):
+        pass
+
+class Bucket:
+    def blob(self, name, chunk_size=None):
+        return Blob(name, chunk_size)
+
+def buffered(bucket, date):
+    # What backupapod did before it streamed: a new connection per image, and the whole
+    # image in memory before uploading it.
+    import requests
+
+    pic_resp = requests.get(url)
+    bucket.blob(f"apod/{date}.jpg").upload_from_string(
+        pic_resp.content, content_type=pic_resp.headers.get("Content-Type")
+    )
+
+before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+start = time.perf_counter()
+for i in range(runs):
+    date = f"2000-01-{i + 1:02d}"
+    if mode == "streaming":
+        main.apod_metadata[date] = {"date": date, "media_type": "image", "url": url}
+        main.save_apod(Bucket(), date)
+    else:
+        buffered(Bucket(), date)
+elapsed = time.perf_counter() - start
+after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(before, after, elapsed)
+"""
+
+
+def measure_backups(functions_dir: str, url: str, mode: str, runs: int) -> tuple[int, int, float]:
+    """Back up the image `runs` times in a fresh interpreter.
+
+    Returns:
+        The peak RSS in KiB after importing main.py and after the backups, and how long
+        the backups took in seconds.
+    """
+    env = {
+        "FIREBASE_CONFIG": '{"projectId": "demo-apodbench"}',
+        "GCLOUD_PROJECT": "demo-apodbench",
+        "BACKUP_BUCKET": "demo-apodbench.appspot.com",
+        "NASA_API_KEY": "DEMO_KEY",
+    }
+    env.update(os.environ)
+    result = subprocess.run(
+        [sys.executable, "-c", backup_runner, functions_dir, url, mode, str(runs)],
+        capture_output=True,
+        env=env,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.decode("utf-8").strip().splitlines()[-1])
+    before, after, elapsed = result.stdout.decode("utf-8").split()[-3:]
+    return int(before), int(after), float(elapsed)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("--image-mb", type=float, default=64, help="size of the image in MiB")
+    argparser.add_argument(
+        "--runs", "-n", type=int, default=5, help="number of backups to time per mode"
+    )
+    argparser.add_argument(
+        "functions_dir",
+        nargs="?",
+        default="taskqueues-backup-images/functions",
+        help="the functions directory whose main.py to benchmark",
+    )
+    args = argparser.parse_args()
+
+    StandInImageHost.image_bytes = int(args.image_mb * 2**20)
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), StandInImageHost)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/image.jpg"
+
+    for mode in ("buffered", "streaming"):
+        before, after, elapsed = measure_backups(args.functions_dir, url, mode, args.runs)
+        throughput = StandInImageHost.image_bytes * args.runs / 2**20 / elapsed
+        print(
+            f"{mode:>9}: {throughput:7.1f} MiB/s, peak RSS {after / 1024:7.1f} MiB,"
+            f" {(after - before) / 1024:7.1f} MiB over import"
+        )
+    server.shutdown()
@@ -0,0 +1,287 @@
+"""Utility to run the thumbnails sample's backfill end to end against a local fake GCS server,
+with a stand-in task queue, and time how long it takes to backfill a bucket of images and to
+run again once every image is up to date."""
+
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import base64
+import contextlib
+import hashlib
+import http.server
+import io
+import itertools
+import json
+import os
+import pathlib
+import sys
+import threading
+import time
+import types
+import urllib.parse
+
+
+class StandInObject(types.SimpleNamespace):
+    """An object's data and the metadata the JSON API returns for it."""
+
+    def resource(self, bucket: str, name: str) -> dict:
+        return {
+            "kind": "storage#object",
+            "bucket": bucket,
+            "name": name,
+            "generation": str(self.generation),
+            "metageneration": "1",
+            "contentType": self.content_type,
+            "size": str(len(self.data)),
+            "md5Hash": self.md5_hash,
+            "crc32c": self.crc32c,
+            "metadata": self.metadata,
+        }
+
+
+class FakeGCS(http.server.BaseHTTPRequestHandler):
+    """Serves the parts of the Cloud Storage JSON API the backfill uses, from memory: listing,
+    object metadata, ranged downloads, and multipart and resumable uploads."""
+
+    protocol_version = "HTTP/1.1"
+    objects: dict[tuple[str, str], StandInObject] = {}
+    uploads: dict[str, dict] = {}
+    generations = itertools.count(1)
+    lock = threading.Lock()
+
+    @classmethod
+    def put(cls, bucket: str, name: str, data: bytes, content_type: str, metadata=None):
+        import google_crc32c
+
+        with cls.lock:
+            cls.objects[bucket, name] = StandInObject(
+                data=data,
+                content_type=content_type,
+                metadata=metadata,
+                generation=next(cls.generations),
+                md5_hash=base64.b64encode(hashlib.md5(data).digest()).decode(),
+                crc32c=base64.b64encode(google_crc32c.Checksum(data).digest()).decode(),
+            )
+            return cls.objects[bucket, name].resource(bucket, name)
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        parts = [urllib.parse.unquote(part) for part in url.path.split("/")]
+        if parts[1:4] == ["storage", "v1", "b"] and len(parts) == 6:
+            return self.list_objects(parts[4], query)
+        if parts[1:4] == ["storage", "v1", "b"] and len(parts) == 7:
+            return self.get_object(parts[4], parts[6], media=False)
+        if parts[1:5] == ["download", "storage", "v1", "b"] and len(parts) == 8:
+            return self.get_object(parts[5], parts[7], media=True)
+        self.send_json(404, {"error": {"code": 404, "message": "Not Found"}})
+
+    def do_POST(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        bucket = urllib.parse.unquote(url.path.split("/")[5])
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        if query["uploadType"] == "multipart":
+            boundary = self.headers.get_param("boundary").encode()
+            metadata_part, data_part = body.split(b"--" + boundary)[1:3]
+            metadata = json.loads(metadata_part.split(b"\r\n\r\n", 1)[1])
+            data = data_part.split(b"\r\n\r\n", 1)[1][: -len(b"\r\n")]
+            return self.send_json(200, self.put_upload(bucket, metadata, data))
+        upload_id = f"upload{len(self.uploads)}-{time.monotonic_ns()}"
+        self.uploads[upload_id] = {"bucket": bucket, "metadata": json.loads(body), "data": b""}
+        self.send_response(200)
+        self.send_header(
+            "Location", f"http://{self.headers['Host']}{url.path}?upload_id={upload_id}"
+        )
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_PUT(self):
+        upload = self.uploads[
+            dict(urllib.parse.parse_qsl(urllib.parse.urlsplit(self.path).query))["upload_id"]
+        ]
+        upload["data"] += self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if not self.headers["Content-Range"].endswith("/*"):
+            return self.send_json(
+                200, self.put_upload(upload["bucket"], upload["metadata"], upload["data"])
+            )
+        self.send_response(308)
+        self.send_header("Range", f"bytes=0-{len(upload['data']) - 1}")
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def put_upload(self, bucket: str, metadata: dict, data: bytes) -> dict:
+        return self.put(
+            bucket,
+            metadata["name"],
+            data,
+            metadata.get("contentType", "application/octet-stream"),
+            metadata.get("metadata"),
+        )
+
+    def list_objects(self, bucket: str, query: dict):
+        names = sorted(
+            name
+            for object_bucket, name in self.objects
+            if object_bucket == bucket and name.startswith(query.get("prefix", ""))
+        )
+        start = int(query.get("pageToken", 0))
+        end = start + int(query.get("maxResults", 1000))
+        listing = {
+            "items": [
+                self.objects[bucket, name].resource(bucket, name) for name in names[start:end]
+            ]
+        }
+        if end < len(names):
+            listing["nextPageToken"] = str(end)
+        self.send_json(200, listing)
+
+    def get_object(self, bucket: str, name: str, media: bool):
+        stored = self.objects.get((bucket, name))
+        if stored is None:
+            return self.send_json(404, {"error": {"code": 404, "message": "No such object"}})
+        if not media:
+            return self.send_json(200, stored.resource(bucket, name))
+        data, status = stored.data, 200
+        if (byte_range := self.headers.get("Range")) is not None:
+            first, last = (int(end) for end in byte_range.removeprefix("bytes=").split("-"))
+            last = min(last, len(stored.data) - 1)
+            data, status = stored.data[first : last + 1], 206
+        self.send_response(status)
+        self.send_header("Content-Type", stored.content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("X-Goog-Generation", str(stored.generation))
+        if status == 206:
+            self.send_header("Content-Range", f"bytes {first}-{last}/{len(stored.data)}")
+        else:
+            self.send_header("X-Goog-Hash", f"crc32c={stored.crc32c},md5={stored.md5_hash}")
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_json(self, status: int, body: dict):
+        encoded = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(encoded)))
+        self.end_headers()
+        self.wfile.write(encoded)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StandInTaskQueue:
+    """Holds enqueued tasks until the benchmark runs them, as Cloud Tasks would dispatch them."""
+
+    tasks: list[dict] = []
+
+    def enqueue(self, task_data: dict, opts=None) -> str:
+        self.tasks.append(task_data)
+        return f"task{len(self.tasks)}"
+
+
+def noisy_jpeg(width: int) -> bytes:
+    """A noisy 4:3 JPEG, which compresses about as badly as a photo."""
+    from PIL import Image
+
+    size = (width, width * 3 // 4)
+    bands = [Image.effect_noise(size, sigma) for sigma in (40, 60, 80)]
+    encoded = io.BytesIO()
+    Image.merge("RGB", bands).save(encoded, format="jpeg")
+    return encoded.getvalue()
+
+
+def run_backfill(backfillthumbnails, data: dict) -> tuple[float, int, dict]:
+    """Run a backfill and the continuation tasks it enqueues until it's done.
+
+    Returns:
+        How long it took in seconds, the number of tasks run, and the last task's result.
+    """
+    StandInTaskQueue.tasks = [data]
+    runs = 0
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):  # The function logs every task.
+        while StandInTaskQueue.tasks:
+            result = backfillthumbnails(types.SimpleNamespace(data=StandInTaskQueue.tasks.pop(0)))
+            runs += 1
+    return time.perf_counter() - start, runs, result
+
+
+if __name__ == "__main__":
+    import argparse
+
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("--images", type=int, default=48, help="number of images to backfill")
+    argparser.add_argument(
+        "--width", "-w", type=int, default=2000, help="width in pixels of the 4:3 images"
+    )
+    argparser.add_argument(
+        "--page-size", type=int, default=16, help="number of objects to list at a time"
+    )
+    argparser.add_argument(
+        "--budget-seconds",
+        type=float,
+        default=0,
+        help="time budget of each task; 0 runs one page per task",
+    )
+    argparser.add_argument(
+        "functions_dir",
+        nargs="?",
+        default="thumbnails/functions",
+        help="the functions directory whose main.py to benchmark",
+    )
+    args = argparser.parse_args()
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), FakeGCS)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    # The worker processes inherit the environment, so they use the fake server too.
+    bucket = "demo-backfillbench.appspot.com"
+    os.environ["STORAGE_EMULATOR_HOST"] = f"http://127.0.0.1:{server.server_address[1]}"
+    os.environ.setdefault(
+        "FIREBASE_CONFIG", json.dumps({"projectId": "demo-backfillbench", "storageBucket": bucket})
+    )
+    os.environ.setdefault("GCLOUD_PROJECT", "demo-backfillbench")
+    sys.path.insert(0, args.functions_dir)
+    from firebase_admin import functions
+    import main
+
+    main.BACKFILL_PAGE_SIZE = args.page_size
+    main.BACKFILL_TIME_BUDGET_SECONDS = args.budget_seconds
+    functions.task_queue = lambda function_name, app=None: StandInTaskQueue()
+
+    image = noisy_jpeg(args.width)
+    for i in range(args.images):
+        FakeGCS.put(bucket, f"photos/{i:05d}.jpg", image, "image/jpeg")
+    FakeGCS.put(bucket, "photos/notes.txt", b"Not an image.", "text/plain")
+
+    # Every image should end up with every rendition, each made from the current original.
+    expected_thumbnails = {
+        (bucket, str(main.rendition_path(pathlib.PurePath(f"photos/{i:05d}.jpg"), rendition)))
+        for i in range(args.images)
+        for rendition in main.parse_renditions(main.RENDITIONS.value)
+    }
+    for label, counted in (("first run", "generated"), ("up to date", "skipped")):
+        elapsed, tasks, result = run_backfill(
+            main.backfillthumbnails.__wrapped__, {"prefix": "photos/"}
+        )
+        print(
+            f"{label:>10}: {elapsed:7.2f} s, {args.images / elapsed:6.1f} images/s,"
+            f" {tasks} tasks, {result}"
+        )
+        if not result["done"] or result[counted] != args.images:
+            raise AssertionError(f"Expected all {args.images} images to be {counted}.")
+        if missing := expected_thumbnails - FakeGCS.objects.keys():
+            raise AssertionError(f"Thumbnails are missing: {sorted(missing)[:5]}")
+    server.shutdown()
@@ -0,0 +1,128 @@
+"""Utility to compare checkforban's ban check with and without the in-memory banned emails,
+against the Firestore emulator or a local stand-in for Firestore."""
+
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import statistics
+import sys
+import time
+import types
+
+
+class StandInCollection:
+    """Takes as long to read a document as Firestore, and delivers the whole collection to
+    a listener at once."""
+
+    read_latency = 0.0
+
+    def __init__(self, doc_ids: set[str]):
+        self.doc_ids = doc_ids
+
+    def document(self, doc_id: str):
+        def get():
+            time.sleep(self.read_latency)
+            return types.SimpleNamespace(exists=doc_id in self.doc_ids)
+
+        return types.SimpleNamespace(get=get)
+
+    def on_snapshot(self, callback):
+        docs = [types.SimpleNamespace(id=doc_id) for doc_id in self.doc_ids]
+        callback(docs, [], None)
+        return types.SimpleNamespace(is_active=True, unsubscribe=lambda: None)
+
+
+def time_checks(contains, emails: list[str]) -> list[float]:
+    times = []
+    for email in emails:
+        start = time.perf_counter()
+        contains(email)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def summarize(times: list[float]) -> str:
+    p50, p99 = (statistics.quantiles(times, n=100)[i] for i in (49, 98))
+    return f"p50 {p50 * 1000:8.3f} ms, p99 {p99 * 1000:8.3f} ms"
+
+
+if __name__ == "__main__":
+    import argparse
+
+    argparser = argparse.ArgumentParser(
+        description="Uses the Firestore emulator if FIRESTORE_EMULATOR_HOST is set."
+    )
+    argparser.add_argument(
+        "--banned", type=int, default=1000, help="number of banned emails to create"
+    )
+    argparser.add_argument(
+        "--sign-ins", "-n", type=int, default=500, help="number of sign-ins to time per check"
+    )
+    argparser.add_argument(
+        "--read-ms",
+        type=float,
+        default=15,
+        help="milliseconds a document read takes, without the emulator",
+    )
+    argparser.add_argument(
+        "functions_dir",
+        nargs="?",
+        default="quickstarts/auth-blocking-functions/functions",
+        help="the functions directory whose main.py to benchmark",
+    )
+    args = argparser.parse_args()
+
+    # The function decorators need a project config to import outside of the emulator.
+    os.environ.setdefault("FIREBASE_CONFIG", '{"projectId": "demo-bannedemailsbench"}')
+    os.environ.setdefault("GCLOUD_PROJECT", "demo-bannedemailsbench")
+    sys.path.insert(0, args.functions_dir)
+    from firebase_admin import firestore
+    import main
+
+    collection = "bannedemailsbench"
+    banned = {f"banned{i}@example.com" for i in range(args.banned)}
+    if "FIRESTORE_EMULATOR_HOST" in os.environ:
+        print(f"Using the Firestore emulator at {os.environ['FIRESTORE_EMULATOR_HOST']}")
+        firestore_client = firestore.client()
+        emails = list(banned)
+        for start in range(0, len(emails), 500):
+            batch = firestore_client.batch()
+            for email in emails[start : start + 500]:
+                batch.set(firestore_client.collection(collection).document(email), {})
+            batch.commit()
+    else:
+        print(f"Using a stand-in for Firestore whose reads take {args.read_ms} ms")
+        StandInCollection.read_latency = args.read_ms / 1000
+        stand_in = StandInCollection(banned)
+        firestore.client = lambda: types.SimpleNamespace(collection=lambda name: stand_in)
+
+    def read_document(email: str) -> bool:
+        """The check checkforban made before the banned emails were kept in memory."""
+        return firestore.client().collection(collection).document(email).get().exists
+
+    banned_emails = main.BannedEmails(collection)
+    banned_emails.listen()
+    if not banned_emails.ready.wait(timeout=60):
+        raise TimeoutError("The banned emails listener didn't load in time.")
+
+    # Half banned, half not.
+    sign_ins = [
+        f"banned{i % args.banned}@example.com" if i % 2 == 0 else f"user{i}@example.com"
+        for i in range(args.sign_ins)
+    ]
+    checks = [("document read", read_document), ("BannedEmails", banned_emails.contains)]
+    for label, contains in checks:
+        print(f"{label:>13}: {summarize(time_checks(contains, sign_ins))}")
+    banned_emails.watch.unsubscribe()
@@ -0,0 +1,93 @@
+"""Utility to measure how long each sample's main.py takes to import on a cold start."""
+
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import pathlib
+import statistics
+import subprocess
+import sys
+import tempfile
+
+# Times the import in a fresh interpreter, so nothing is cached from a previous run.
+import_timer = """
+import sys, time
+sys.path.insert(0, sys.argv[1])
+start = time.perf_counter()
+import main
+print(time.perf_counter() - start)
+"""
+
+# The function decorators need a project config to import outside of the emulator.
+demo_firebase_config = (
+    '{"projectId": "demo-coldstart", "storageBucket": "demo-coldstart.appspot.com",'
+    ' "databaseURL": "https://demo-coldstart.firebaseio.com"}'
+)
+
+
+def time_import(functions_dir: str, runs: int) -> list[float]:
+    env = {"FIREBASE_CONFIG": demo_firebase_config, "GCLOUD_PROJECT": "demo-coldstart"}
+    env.update(os.environ)
+    times = []
+    for _ in range(runs):
+        result = subprocess.run(
+            [sys.executable, "-c", import_timer, functions_dir], capture_output=True, env=env
+        )
+        if result.returncode != 0:
+            raise ImportError(result.stderr.decode("utf-8").strip().splitlines()[-1])
+        times.append(float(result.stdout.decode("utf-8").split()[-1]))
+    return times
+
+
+def time_import_at(ref: str, main_py: pathlib.Path, runs: int) -> list[float]:
+    """Time the import of main.py as it was at a git ref."""
+    result = subprocess.run(["git", "show", f"{ref}:./{main_py}"], capture_output=True, check=True)
+    with tempfile.TemporaryDirectory() as functions_dir:
+        (pathlib.Path(functions_dir) / "main.py").write_bytes(result.stdout)
+        return time_import(functions_dir, runs)
+
+
+def summarize(times: list[float]) -> str:
+    return f"median {statistics.median(times) * 1000:7.1f} ms, min {min(times) * 1000:7.1f} ms"
+
+
+if __name__ == "__main__":
+    import argparse
+
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument(
+        "--baseline",
+        "-b",
+        help="also time each sample as it was at this git ref, for comparison",
+    )
+    argparser.add_argument(
+        "--runs", "-n", type=int, default=5, help="number of cold imports to time per sample"
+    )
+    argparser.add_argument("main_py_or_glob", nargs="+")
+    args = argparser.parse_args()
+
+    files = sorted(
+        {f for fs in [pathlib.Path(".").glob(fg) for fg in args.main_py_or_glob] for f in fs}
+    )
+    for file in files:
+        print(f"{file.parent.parent}")
+        runs = [("current", lambda: time_import(str(file.parent), args.runs))]
+        if args.baseline is not None:
+            runs.append((args.baseline, lambda: time_import_at(args.baseline, file, args.runs)))
+        for label, run in runs:
+            try:
+                print(f"  {label:>10}: {summarize(run())}")
+            except ImportError as error:
+                print(f"  {label:>10}: failed to import ({error})")
@@ -1,8 +1,44 @@
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import threading
+import time
+from typing import NamedTuple
+
 import firebase_admin
-from firebase_admin import auth, db, messaging, exceptions
-from firebase_functions import db_fn
+from firebase_functions import db_fn, params, scheduler_fn
+
+
+@functools.cache
+def get_app() -> firebase_admin.App:
+    """Initialize the Admin SDK on first use, then reuse it for the life of the instance.
+
+    The Auth, Realtime Database and Cloud Messaging modules are also imported on first use,
+    so invocations that exit early (such as for un-follows) don't pay for them on cold start.
+    """
+    return firebase_admin.initialize_app()
+
+
+# Buffer follows and send one notification per user per window, instead of one per follow.
+COALESCE_NOTIFICATIONS = params.BoolParam("COALESCE_NOTIFICATIONS", default=False)
+COALESCE_WINDOW_MINUTES = params.IntParam("COALESCE_WINDOW_MINUTES", default=5)
+# Notify at most this many users per window, so a flush finishes before it times out.
+COALESCE_MAX_USERS = params.IntParam("COALESCE_MAX_USERS", default=1000)
+
+# FCM accepts at most this many messages in one send_each call.
+FCM_BATCH_SIZE = 500
+
+# Send at most this many of one invocation's batches at once.
+FCM_CONCURRENT_BATCHES = 2
 
-firebase_admin.initialize_app()
+# send_each starts a thread per message, so also send at most this many batches at once per
+# instance, across every invocation it's handling. This leaves room for other invocations'
+# batches while one invocation sends to a popular account.
+FCM_INSTANCE_CONCURRENT_BATCHES = 2 * FCM_CONCURRENT_BATCHES
+fcm_send_slots = threading.BoundedSemaphore(FCM_INSTANCE_CONCURRENT_BATCHES)
+
+# Read and notify this many users' buffered follows at once.
+FLUSH_WORKERS = 4
 
 
 @db_fn.on_value_written(reference=r"followers/{followedUid}/{followerUid}")
@@ -20,40 +56,313 @@ def send_follower_notification(event: db_fn.Event[db_fn.Change]) -> None:
     change = event.data
     if not change.after:
         print(f"User {follower_uid} unfollowed user {followed_uid} :(")
+        if COALESCE_NOTIFICATIONS.value:
+            # Don't tell the user about a follow that's already been undone.
+            from firebase_admin import db
+
+            db.reference(f"follow_buffer/{followed_uid}/{follower_uid}", app=get_app()).delete()
         return
 
     print(f"User {follower_uid} is now following user {followed_uid}")
-    tokens_ref = db.reference(f"users/{followed_uid}/notificationTokens")
+    if COALESCE_NOTIFICATIONS.value:
+        # Buffer the follow for flushfollowernotifications to send with the others.
+        from firebase_admin import db
+
+        db.reference(f"follow_buffer/{followed_uid}/{follower_uid}", app=get_app()).set(
+            {".sv": "timestamp"}
+        )
+        return
+
+    notify_followed_user(followed_uid, [follower_uid])
+
+
+@scheduler_fn.on_schedule(schedule=f"every {max(COALESCE_WINDOW_MINUTES.value, 1)} minutes")
+def flushfollowernotifications(event: scheduler_fn.ScheduledEvent) -> None:
+    """Sends one notification per user for the follows buffered since the last run, such
+    as "Ann and 199 others are now following you."
+
+    Follows are buffered in `/follow_buffer/{followedUid}/{followerUid}` when
+    COALESCE_NOTIFICATIONS is set. Up to COALESCE_MAX_USERS users are notified per run;
+    the rest stay buffered until the next run.
+    """
+    if not COALESCE_NOTIFICATIONS.value:
+        return
+    from firebase_admin import db
+
+    buffer_ref = db.reference("follow_buffer", app=get_app())
+    buffered = buffer_ref.get(shallow=True)
+    if not isinstance(buffered, dict):
+        print("There are no buffered follows.")
+        return
+    followed_uids = list(buffered)[: max(COALESCE_MAX_USERS.value, 1)]
+
+    with ThreadPoolExecutor(max_workers=FLUSH_WORKERS) as executor:
+        buffers = dict(
+            zip(followed_uids, executor.map(lambda uid: buffer_ref.child(uid).get(), followed_uids))
+        )
+        # Each user's followers, most recent first.
+        followers = {
+            followed_uid: sorted(follows, key=lambda uid: follows[uid] or 0, reverse=True)
+            for followed_uid, follows in buffers.items()
+            if isinstance(follows, dict) and len(follows) > 0
+        }
+        prefetch_follower_profiles([uids[0] for uids in followers.values()])
+
+        def flush(followed_uid: str) -> None:
+            print(f"User {followed_uid} has {len(followers[followed_uid])} new followers")
+            try:
+                notify_followed_user(followed_uid, followers[followed_uid])
+            finally:
+                # Clear the follows that were read even if sending failed, so a follow
+                # that can't be sent isn't retried forever. Follows buffered since they
+                # were read are sent on the next run.
+                buffer_ref.child(followed_uid).update(
+                    {uid: None for uid in followers[followed_uid]}
+                )
+
+        for future in [executor.submit(flush, uid) for uid in followers]:
+            try:
+                future.result()
+            except Exception as error:
+                print(f"Failed to send a follower notification: {error}")
+    print(f"Sent follower notifications to {len(followers)} users.")
+
+
+# When a user's most recent new follower has since been deleted, try naming this many of
+# the others before falling back to a notification that names nobody.
+NAMED_FOLLOWER_CANDIDATES = 5
+
+
+def notify_followed_user(followed_uid: str, follower_uids: list[str]) -> None:
+    """Send a new follower notification to each of a user's devices.
+
+    Args:
+        followed_uid: The user to notify.
+        follower_uids: The new followers, most recent first. The first one that still
+            exists is named in the notification, and the rest are counted.
+    """
+    from firebase_admin import db, messaging
+
+    tokens_ref = db.reference(f"users/{followed_uid}/notificationTokens", app=get_app())
     notification_tokens = tokens_ref.get()
     if not isinstance(notification_tokens, dict) or len(notification_tokens) < 1:
         print("There are no tokens to send notifications to.")
         return
     print(f"There are {len(notification_tokens)} tokens to send notifications to.")
 
-    follower: auth.UserRecord = auth.get_user(follower_uid)
+    follower = find_follower_profile(follower_uids[:NAMED_FOLLOWER_CANDIDATES])
+    others = len(follower_uids) - 1
+    if follower is None:
+        body = (
+            "Someone is now following you."
+            if others < 1
+            else f"{len(follower_uids)} people are now following you."
+        )
+    elif others < 1:
+        body = f"{follower.display_name} is now following you."
+    else:
+        body = (
+            f"{follower.display_name} and {others} other{'s' if others > 1 else ''}"
+            " are now following you."
+        )
     notification = messaging.Notification(
-        title="You have a new follower!",
-        body=f"{follower.display_name} is now following you.",
-        image=follower.photo_url if follower.photo_url else "",
+        title="You have a new follower!" if others < 1 else "You have new followers!",
+        body=body,
+        image=follower.photo_url if follower is not None and follower.photo_url else "",
     )
 
     # Send notifications to all tokens.
-    msgs = [
-        messaging.Message(token=token, notification=notification) for token in notification_tokens
-    ]
-    batch_response: messaging.BatchResponse = messaging.send_each(msgs)
-    if batch_response.failure_count < 1:
-        # Messages sent sucessfully. We're done!
-        return
+    invalid_tokens = send_to_tokens(list(notification_tokens), notification)
+
+    # Clean up the tokens that are not registered any more, in a single write.
+    if invalid_tokens:
+        tokens_ref.update({token: None for token in invalid_tokens})
+        print(f"Removed {len(invalid_tokens)} invalid tokens.")
+
 
-    # Clean up the tokens that are not registered any more.
-    for i in range(len(batch_response.responses)):
-        exception = batch_response.responses[i].exception
-        if not isinstance(exception, exceptions.FirebaseError):
+def send_to_tokens(tokens: list[str], notification) -> list[str]:
+    """Send a notification to each token, in batches sent a few at a time.
+
+    A batch that fails as a whole is logged and skipped, so the other batches are still
+    sent and their invalid tokens still returned.
+
+    Returns:
+        The tokens that are not registered any more or are not valid.
+    """
+    from firebase_admin import exceptions, messaging
+
+    def send_batch(batch: list[str]) -> tuple[float, list[str]]:
+        msgs = [messaging.Message(token=token, notification=notification) for token in batch]
+        with fcm_send_slots:
+            start = time.monotonic()
+            batch_response: messaging.BatchResponse = messaging.send_each(msgs, app=get_app())
+            latency = time.monotonic() - start
+        if batch_response.failure_count < 1:
+            # Messages sent sucessfully. We're done with this batch!
+            return latency, []
+
+        invalid = []
+        for token, response in zip(batch, batch_response.responses):
+            exception = response.exception
+            if not isinstance(exception, exceptions.FirebaseError):
+                continue
+            if isinstance(exception, messaging.UnregisteredError):
+                invalid.append(token)
+            elif exception.http_response is not None:
+                message = exception.http_response.json()["error"]["message"]
+                if message == "The registration token is not a valid FCM registration token":
+                    invalid.append(token)
+        return latency, invalid
+
+    def try_send_batch(batch: list[str]) -> tuple[float, list[str]] | None:
+        try:
+            return send_batch(batch)
+        except exceptions.FirebaseError as error:
+            print(f"Failed to send a batch of {len(batch)} messages: {error}")
+            return None
+
+    batches = [tokens[i : i + FCM_BATCH_SIZE] for i in range(0, len(tokens), FCM_BATCH_SIZE)]
+    if len(batches) == 1:
+        results = [try_send_batch(batches[0])]
+    else:
+        with ThreadPoolExecutor(max_workers=FCM_CONCURRENT_BATCHES) as executor:
+            results = list(executor.map(try_send_batch, batches))
+
+    latencies = []
+    invalid_tokens = []
+    sent = 0
+    for batch, result in zip(batches, results):
+        if result is None:
             continue
-        message = exception.http_response.json()["error"]["message"]
-        if (
-            isinstance(exception, messaging.UnregisteredError)
-            or message == "The registration token is not a valid FCM registration token"
-        ):
-            tokens_ref.child(msgs[i].token).delete()
+        latency, invalid = result
+        sent += len(batch)
+        latencies.append(latency)
+        invalid_tokens.extend(invalid)
+
+    if latencies:
+        latencies.sort()
+        print(
+            f"Sent {sent} of {len(tokens)} messages in {len(latencies)} batches."
+            f" Batch latency p50 {percentile(latencies, 50) * 1000:.0f} ms,"
+            f" p90 {percentile(latencies, 90) * 1000:.0f} ms,"
+            f" p99 {percentile(latencies, 99) * 1000:.0f} ms."
+        )
+    return invalid_tokens
+
+
+def percentile(sorted_values: list[float], percent: int) -> float:
+    """The nearest-rank percentile of a non-empty sorted list."""
+    return sorted_values[max(0, -(-len(sorted_values) * percent // 100) - 1)]
+
+
+class FollowerProfile(NamedTuple):
+    """The parts of a follower's user record that notifications show."""
+
+    display_name: str | None
+    photo_url: str | None
+
+
+# Remember this many follower profiles, for this long. A burst of follows from the same
+# account then looks the follower up in Auth only once. Profile changes show up in
+# notifications after at most the TTL.
+FOLLOWER_PROFILES_MAX = 10_000
+FOLLOWER_PROFILE_TTL_SECONDS = 5 * 60
+
+# Auth looks up at most this many users in one get_users call.
+GET_USERS_BATCH_SIZE = 100
+
+# uid -> (time cached, profile), least recently used first.
+follower_profiles: collections.OrderedDict[
+    str, tuple[float, FollowerProfile]
+] = collections.OrderedDict()
+follower_profiles_lock = threading.Lock()
+
+# Counts of cache hits, misses and expired entries, logged with each lookup so the hit rate
+# can be followed in the function logs.
+follower_profile_stats: collections.Counter[str] = collections.Counter()
+
+
+def get_follower_profile(uid: str) -> FollowerProfile:
+    """Get a follower's profile from this instance's cache, or from Auth on a miss."""
+    profile = cached_follower_profile(uid)
+    if profile is None:
+        follower_profile_stats["misses"] += 1
+        prefetch_follower_profiles([uid])
+        profile = cached_follower_profile(uid)
+    else:
+        follower_profile_stats["hits"] += 1
+    hits = follower_profile_stats["hits"]
+    lookups = hits + follower_profile_stats["misses"]
+    print(
+        f"Follower profile cache hit rate {hits / lookups:.0%} over {lookups} lookups."
+        f" {dict(follower_profile_stats)}"
+    )
+    if profile is None:
+        # Let Auth raise UserNotFoundError, as it did before the cache.
+        from firebase_admin import auth
+
+        user: auth.UserRecord = auth.get_user(uid, app=get_app())
+        return FollowerProfile(user.display_name, user.photo_url)
+    return profile
+
+
+def find_follower_profile(uids: list[str]) -> FollowerProfile | None:
+    """Get the profile of the first of these followers that still exists, if any."""
+    from firebase_admin import auth
+
+    for uid in uids:
+        try:
+            return get_follower_profile(uid)
+        except auth.UserNotFoundError:
+            print(f"Follower {uid} no longer exists.")
+    return None
+
+
+def prefetch_follower_profiles(uids: list[str]) -> None:
+    """Look up the profiles of several followers that aren't cached yet, with one Auth
+    request per 100 users, and cache them.
+
+    Call this when several follow events are handled together, so that the following
+    get_follower_profile calls are cache hits.
+    """
+    from firebase_admin import auth
+
+    with follower_profiles_lock:
+        now = time.monotonic()
+        missing = list(
+            dict.fromkeys(
+                uid
+                for uid in uids
+                if uid not in follower_profiles
+                or now - follower_profiles[uid][0] > FOLLOWER_PROFILE_TTL_SECONDS
+            )
+        )
+    for i in range(0, len(missing), GET_USERS_BATCH_SIZE):
+        result = auth.get_users(
+            [auth.UidIdentifier(uid) for uid in missing[i : i + GET_USERS_BATCH_SIZE]],
+            app=get_app(),
+        )
+        now = time.monotonic()
+        with follower_profiles_lock:
+            for user in result.users:
+                follower_profiles[user.uid] = (
+                    now,
+                    FollowerProfile(user.display_name, user.photo_url),
+                )
+                follower_profiles.move_to_end(user.uid)
+            while len(follower_profiles) > FOLLOWER_PROFILES_MAX:
+                follower_profiles.popitem(last=False)
+
+
+def cached_follower_profile(uid: str) -> FollowerProfile | None:
+    """Get a follower's profile from this instance's cache, if it's there and fresh."""
+    with follower_profiles_lock:
+        entry = follower_profiles.get(uid)
+        if entry is not None and time.monotonic() - entry[0] > FOLLOWER_PROFILE_TTL_SECONDS:
+            del follower_profiles[uid]
+            follower_profile_stats["expired"] += 1
+            return None
+        if entry is None:
+            return None
+        follower_profiles.move_to_end(uid)
+        return entry[1]
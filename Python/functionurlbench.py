@@ -0,0 +1,169 @@
+"""Utility to check that the task queue samples look up a function's URL at most once per
+instance, however many invocations ask for it at the same time, against local stand-ins for
+the metadata server and the Cloud Functions API that take a set time to respond."""
+
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+
+
+class CallCounter:
+    """Counts calls to a stand-in, which take a set time to return."""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def call(self) -> None:
+        with self.lock:
+            self.calls += 1
+        time.sleep(self.latency)
+
+
+def stand_in_functions_api(api: CallCounter):
+    """A requests adapter that answers Cloud Functions API requests with a function whose
+    URL is made up from its name."""
+    import requests
+
+    class StandInFunctionsAPI(requests.adapters.BaseAdapter):
+        def send(self, request, **kwargs):
+            api.call()
+            name = request.url.rsplit("/", 1)[-1]
+            response = requests.Response()
+            response.status_code = 200
+            response.url = request.url
+            response._content = json.dumps(
+                {"serviceConfig": {"uri": f"https://{name}-demo.a.run.app"}}
+            ).encode()
+            return response
+
+        def close(self):
+            pass
+
+    return StandInFunctionsAPI()
+
+
+def time_calls(get_url, calls: int, concurrency: int) -> list[float]:
+    """Time each of `calls` calls, made by `concurrency` threads at once, as concurrent
+    invocations on one instance would make them."""
+
+    def timed_call(_) -> float:
+        start = time.perf_counter()
+        get_url()
+        return time.perf_counter() - start
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return list(executor.map(timed_call, range(calls)))
+
+
+def summarize(times: list[float]) -> str:
+    p50, p99 = (statistics.quantiles(times, n=100)[i] for i in (49, 98))
+    return f"p50 {p50 * 1000:7.2f} ms, p99 {p99 * 1000:7.2f} ms"
+
+
+if __name__ == "__main__":
+    import argparse
+
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument(
+        "--calls", "-n", type=int, default=1000, help="number of invocations that need the URL"
+    )
+    argparser.add_argument(
+        "--concurrency",
+        "-c",
+        type=int,
+        default=80,
+        help="number of invocations an instance handles at once",
+    )
+    argparser.add_argument(
+        "--metadata-ms",
+        type=float,
+        default=50,
+        help="milliseconds getting credentials from the metadata server takes",
+    )
+    argparser.add_argument(
+        "--lookup-ms",
+        type=float,
+        default=150,
+        help="milliseconds looking up a function with the Cloud Functions API takes",
+    )
+    argparser.add_argument(
+        "--function",
+        default="scheduleonboarding",
+        help="the task queue function whose URL the sample looks up",
+    )
+    argparser.add_argument(
+        "functions_dir",
+        nargs="?",
+        default="post-signup-event/functions",
+        help="the functions directory whose main.py to benchmark",
+    )
+    args = argparser.parse_args()
+
+    # The function decorators need a project config to import outside of the emulator.
+    os.environ.setdefault("FIREBASE_CONFIG", '{"projectId": "demo-functionurlbench"}')
+    os.environ.setdefault("GCLOUD_PROJECT", "demo-functionurlbench")
+    os.environ.pop(f"FUNCTION_URL_{args.function.upper()}", None)
+    sys.path.insert(0, args.functions_dir)
+    import google.auth
+    from google.auth.credentials import AnonymousCredentials
+    import google.auth.transport.requests
+    import main
+
+    metadata = CallCounter(args.metadata_ms / 1000)
+    api = CallCounter(args.lookup_ms / 1000)
+
+    def default(scopes=None):
+        metadata.call()
+        return AnonymousCredentials(), "demo-functionurlbench"
+
+    # Sessions send Cloud Functions API requests to the stand-in instead.
+    AuthorizedSession = google.auth.transport.requests.AuthorizedSession
+    init_session = AuthorizedSession.__init__
+
+    def init_stand_in_session(self, credentials, **kwargs):
+        init_session(self, credentials, **kwargs)
+        self.mount("https://cloudfunctions.googleapis.com/", stand_in_functions_api(api))
+
+    google.auth.default = default
+    AuthorizedSession.__init__ = init_stand_in_session
+
+    def uncached_lookup() -> str:
+        """What the samples did before caching: new credentials and a lookup every time."""
+        main.get_authorized_session.cache_clear()
+        return main.lookup_function_url(args.function, "us-central1")
+
+    checks = [
+        ("uncached lookup", uncached_lookup),
+        ("get_function_url", lambda: main.get_function_url(args.function)),
+    ]
+    for label, get_url in checks:
+        main.get_authorized_session.cache_clear()
+        main.function_urls.clear()
+        metadata.calls, api.calls = 0, 0
+        times = time_calls(get_url, args.calls, args.concurrency)
+        print(
+            f"{label:>16}: {summarize(times)}, {metadata.calls} metadata calls,"
+            f" {api.calls} API calls for {args.calls} invocations"
+        )
+    if metadata.calls > 1 or api.calls > 1:
+        raise AssertionError("get_function_url looked up the URL more than once.")
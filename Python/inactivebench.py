@@ -0,0 +1,131 @@
+"""Utility to compare the account cleanup sample's batch inactivity check with the per-user
+is_inactive() check it replaced, on generated pages of users."""
+
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from datetime import datetime, timedelta, timezone
+import os
+import random
+import statistics
+import sys
+import time
+
+
+def is_inactive(user, inactive_limit: timedelta) -> bool:
+    """The sample's original check, called once per user."""
+    if user.user_metadata.last_refresh_timestamp is not None:
+        last_seen_timestamp = user.user_metadata.last_refresh_timestamp / 1000
+    elif user.user_metadata.last_sign_in_timestamp is not None:
+        last_seen_timestamp = user.user_metadata.last_sign_in_timestamp / 1000
+    elif user.user_metadata.creation_timestamp is not None:
+        last_seen_timestamp = user.user_metadata.creation_timestamp / 1000
+    else:
+        raise ValueError
+    last_seen = datetime.fromtimestamp(last_seen_timestamp)
+    inactive_time = datetime.now() - last_seen
+    return inactive_time >= inactive_limit
+
+
+def random_users(count: int, now_millis: int, inactive_limit: timedelta, rng: random.Random):
+    """Users last seen up to twice the inactive limit ago, with a mix of the metadata Auth
+    returns. None are within a minute of the limit, so both checks see them the same way
+    however long the run takes."""
+    from firebase_admin import auth
+
+    limit_millis = int(inactive_limit.total_seconds() * 1000)
+    users = []
+    for i in range(count):
+        age = rng.randrange(0, 2 * limit_millis)
+        if abs(age - limit_millis) < 60_000:
+            age += 120_000
+        last_seen = now_millis - age
+        data = {"localId": f"user{i}", "createdAt": str(last_seen - 1000)}
+        kind = rng.random()
+        if kind < 0.6:
+            refreshed = datetime.fromtimestamp(last_seen / 1000, timezone.utc)
+            data["lastRefreshAt"] = refreshed.isoformat(timespec="milliseconds")
+            data["lastLoginAt"] = str(last_seen - 500)
+        elif kind < 0.9:
+            data["lastLoginAt"] = str(last_seen)
+        else:
+            data["createdAt"] = str(last_seen)
+        users.append(auth.UserRecord(data))
+    return users
+
+
+def time_runs(classify, runs: int) -> tuple[list[float], list[str]]:
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = classify()
+        times.append(time.perf_counter() - start)
+    return times, result
+
+
+def summarize(times: list[float], users: int) -> str:
+    median = statistics.median(times)
+    return f"median {median * 1000:8.2f} ms per page, {median / users * 1e6:6.2f} us per user"
+
+
+if __name__ == "__main__":
+    import argparse
+
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument(
+        "--users", "-u", type=int, default=1000, help="number of users per page, as listed"
+    )
+    argparser.add_argument(
+        "--runs", "-n", type=int, default=20, help="number of times to classify the page"
+    )
+    argparser.add_argument(
+        "functions_dir",
+        nargs="?",
+        default="delete-unused-accounts-cron/functions",
+        help="the functions directory whose main.py to benchmark",
+    )
+    args = argparser.parse_args()
+
+    # The function decorators need a project config to import outside of the emulator.
+    os.environ.setdefault("FIREBASE_CONFIG", '{"projectId": "demo-inactivebench"}')
+    os.environ.setdefault("GCLOUD_PROJECT", "demo-inactivebench")
+    sys.path.insert(0, args.functions_dir)
+    import main
+
+    now_millis = int(time.time() * 1000)
+    cutoff_millis = now_millis - int(main.INACTIVE_LIMIT.total_seconds() * 1000)
+    users = random_users(args.users, now_millis, main.INACTIVE_LIMIT, random.Random(0))
+    last_seen = main.last_seen_array(users)
+
+    checks = [
+        (
+            "is_inactive",
+            lambda: [user.uid for user in users if is_inactive(user, main.INACTIVE_LIMIT)],
+        ),
+        (
+            "batch",
+            lambda: main.inactive_uids(users, main.last_seen_array(users), cutoff_millis),
+        ),
+        (
+            "compare only",
+            lambda: main.inactive_uids(users, last_seen, cutoff_millis),
+        ),
+    ]
+    results = {}
+    for label, classify in checks:
+        times, results[label] = time_runs(classify, args.runs)
+        print(f"{label:>12}: {summarize(times, len(users))}")
+    if len({tuple(result) for result in results.values()}) != 1:
+        raise AssertionError("The checks picked different users.")
+    print(f"All checks picked the same {len(results['batch'])} of {len(users)} users.")
@@ -0,0 +1,135 @@
+"""Utility to compare the auth blocking sample's IP blocklist lookups with a linear scan of
+the same networks with the ipaddress module, for blocklists of increasing size."""
+
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import ipaddress
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+
+def random_networks(count: int, rng: random.Random) -> list[str]:
+    """Mostly single IPv4 addresses, some IPv4 ranges, and some IPv6 /64s."""
+    networks = []
+    for _ in range(count):
+        kind = rng.random()
+        if kind < 0.7:
+            networks.append(str(ipaddress.IPv4Address(rng.getrandbits(32))))
+        elif kind < 0.9:
+            prefix = rng.choice([16, 20, 24, 28])
+            networks.append(f"{ipaddress.IPv4Address(rng.getrandbits(32))}/{prefix}")
+        else:
+            networks.append(f"{ipaddress.IPv6Address(rng.getrandbits(128))}/64")
+    return networks
+
+
+def random_addresses(networks: list[str], count: int, rng: random.Random) -> list[str]:
+    """Half addresses inside the networks, half random IPv4 and IPv6 addresses."""
+    addresses = []
+    for i in range(count):
+        if i % 2 == 0:
+            network = ipaddress.ip_network(rng.choice(networks), strict=False)
+            offset = rng.randrange(min(network.num_addresses, 2**32))
+            addresses.append(str(network.network_address + offset))
+        elif i % 4 == 1:
+            addresses.append(str(ipaddress.IPv4Address(rng.getrandbits(32))))
+        else:
+            addresses.append(str(ipaddress.IPv6Address(rng.getrandbits(128))))
+    return addresses
+
+
+def time_lookups(contains, addresses: list[str]) -> tuple[list[float], list[bool]]:
+    times, results = [], []
+    for address in addresses:
+        start = time.perf_counter()
+        results.append(contains(address))
+        times.append(time.perf_counter() - start)
+    return times, results
+
+
+def linear_scan(networks: list[str]):
+    """Check an address against every network in turn."""
+    parsed = [ipaddress.ip_network(network, strict=False) for network in networks]
+
+    def contains(ip_address: str) -> bool:
+        try:
+            address = ipaddress.ip_address(ip_address)
+        except ValueError:
+            return False
+        return any(address in network for network in parsed)
+
+    return contains
+
+
+def summarize(times: list[float]) -> str:
+    p50, p99 = (statistics.quantiles(times, n=100)[i] for i in (49, 98))
+    return f"p50 {p50 * 1e6:9.2f} us, p99 {p99 * 1e6:9.2f} us"
+
+
+if __name__ == "__main__":
+    import argparse
+
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument(
+        "--sizes",
+        "-s",
+        type=int,
+        nargs="+",
+        default=[100, 1000, 10000],
+        help="numbers of networks in the blocklists to time",
+    )
+    argparser.add_argument(
+        "--lookups", "-n", type=int, default=1000, help="number of addresses to look up per size"
+    )
+    argparser.add_argument(
+        "functions_dir",
+        nargs="?",
+        default="quickstarts/auth-blocking-functions/functions",
+        help="the functions directory whose main.py to benchmark",
+    )
+    args = argparser.parse_args()
+
+    # The function decorators need a project config to import outside of the emulator.
+    os.environ.setdefault("FIREBASE_CONFIG", '{"projectId": "demo-ipblocklistbench"}')
+    os.environ.setdefault("GCLOUD_PROJECT", "demo-ipblocklistbench")
+    sys.path.insert(0, args.functions_dir)
+    import main
+
+    rng = random.Random(0)
+    with tempfile.TemporaryDirectory() as blocklist_dir:
+        for size in args.sizes:
+            networks = random_networks(size, rng)
+            addresses = random_addresses(networks, args.lookups, rng)
+            blocklist_path = os.path.join(blocklist_dir, f"{size}.txt")
+            with open(blocklist_path, "w") as blocklist_file:
+                blocklist_file.write("\n".join(networks))
+            os.environ["IP_BLOCKLIST"] = blocklist_path
+
+            blocklist = main.IpBlocklist()
+            start = time.perf_counter()
+            blocklist.contains("127.0.0.1")  # Loads the blocklist.
+            load_time = time.perf_counter() - start
+
+            print(f"{size} networks, loaded in {load_time * 1000:.1f} ms")
+            bisect_times, bisect_results = time_lookups(blocklist.contains, addresses)
+            scan_times, scan_results = time_lookups(linear_scan(networks), addresses)
+            if bisect_results != scan_results:
+                raise AssertionError("The bisect and linear scan lookups disagree.")
+            print(f"  {'IpBlocklist':>11}: {summarize(bisect_times)}")
+            print(f"  {'linear scan':>11}: {summarize(scan_times)}")
@@ -12,20 +12,37 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+import functools
 import json
+import os
+import threading
+import time
 
-from firebase_admin import auth, firestore, initialize_app
-from firebase_functions import https_fn, identity_fn, tasks_fn, options, params
+import firebase_admin
+from firebase_functions import https_fn, identity_fn, scheduler_fn, tasks_fn, options, params
 
-import google.auth
-import google.auth.transport.requests
-import google.cloud.firestore
-import google.cloud.tasks_v2
-import google.oauth2.credentials
-import googleapiclient.discovery
+# Firestore, Cloud Tasks, the Calendar API client and google.auth are imported on first
+# use, so sign-ups that don't use Google as a provider don't pay for them on cold start.
 
-initialize_app()
+
+@functools.cache
+def get_app() -> firebase_admin.App:
+    """Initialize the Admin SDK on first use, then reuse it for the life of the instance."""
+    return firebase_admin.initialize_app()
+
+
+@functools.cache
+def get_tasks_client():
+    """Create a Cloud Tasks client on first use, then reuse its channel."""
+    import google.cloud.tasks_v2
+
+    return google.cloud.tasks_v2.CloudTasksClient()
+
+
+# Have savegoogletoken leave creating the onboarding task to queueonboarding, which runs
+# outside of Auth's deadline for blocking functions.
+DEFER_ONBOARDING_TASKS = params.BoolParam("DEFER_ONBOARDING_TASKS", default=False)
 
 
 # [START savegoogletoken]
@@ -43,29 +60,152 @@ def savegoogletoken(
     """
     if event.credential is not None and event.credential.provider_id == "google.com":
         print(f"Signed in with {event.credential.provider_id}. Saving access token.")
+        from firebase_admin import firestore
 
-        firestore_client: google.cloud.firestore.Client = firestore.client()
+        firestore_client = firestore.client(app=get_app())
         doc_ref = firestore_client.collection("user_info").document(event.data.uid)
+        if DEFER_ONBOARDING_TASKS.value:
+            # Save the token and ask queueonboarding to create the task, in one write,
+            # so sign-up doesn't wait on Cloud Tasks.
+            doc_ref.set(
+                {
+                    "calendar_access_token": event.credential.access_token,
+                    "onboarding_requested": firestore.SERVER_TIMESTAMP,
+                },
+                merge=True,
+            )
+            return
         doc_ref.set({"calendar_access_token": event.credential.access_token}, merge=True)
 
-        tasks_client = google.cloud.tasks_v2.CloudTasksClient()
-        task_queue = tasks_client.queue_path(
-            params.PROJECT_ID.value, options.SupportedRegion.US_CENTRAL1, "scheduleonboarding"
-        )
-        target_uri = get_function_url("scheduleonboarding")
-        calendar_task = google.cloud.tasks_v2.Task(
-            http_request={
-                "http_method": google.cloud.tasks_v2.HttpMethod.POST,
-                "url": target_uri,
-                "headers": {"Content-type": "application/json"},
-                "body": json.dumps({"data": {"uid": event.data.uid}}).encode(),
-            },
-            schedule_time=datetime.now() + timedelta(minutes=1),
-        )
-        tasks_client.create_task(parent=task_queue, task=calendar_task)
+        enqueue_onboarding(event.data.uid)
 # [END savegoogletoken]
 
 
+# Importing firebase_functions.firestore_fn takes about 200 ms, so don't define the Firestore
+# trigger on savegoogletoken's instances, which have to answer within Auth's deadline.
+# FUNCTION_TARGET is the function an instance serves, and isn't set during deploys.
+if os.environ.get("FUNCTION_TARGET") != "savegoogletoken":
+    from firebase_functions import firestore_fn
+
+    @firestore_fn.on_document_written(document="user_info/{uid}")
+    def queueonboarding(
+        event: firestore_fn.Event[firestore_fn.Change[firestore_fn.DocumentSnapshot | None]],
+    ) -> None:
+        """Create the onboarding task that savegoogletoken requested, then clear the
+        request."""
+        after = event.data.after
+        after_data = (after.to_dict() if after is not None else None) or {}
+        requested = after_data.get("onboarding_requested")
+        if requested is None:
+            # No request, including after this function clears one, or after
+            # scheduleonboarding deletes the token.
+            return
+        before = event.data.before
+        before_data = (before.to_dict() if before is not None else None) or {}
+        if before_data.get("onboarding_requested") == requested:
+            return  # Some other field changed.
+        queue_requested_onboarding(after.reference, requested)
+
+
+def queue_requested_onboarding(doc_ref, requested: datetime) -> None:
+    """Create the onboarding task that a user_info document requests, then clear the
+    request."""
+    from firebase_admin import firestore
+
+    # Name the task after the request, so that if the task was created but the request
+    # wasn't cleared, the sweep doesn't create a second task. Cloud Tasks only remembers
+    # names for about an hour, but a later duplicate finds the token already taken and
+    # doesn't add a second event.
+    enqueue_onboarding(doc_ref.id, task_id=f"onboarding-{doc_ref.id}-{requested.timestamp():.0f}")
+    doc_ref.update({"onboarding_requested": firestore.DELETE_FIELD})
+
+
+# Firestore triggers aren't retried, so a request that queueonboarding failed on stays in its
+# document. Sweep for those this often, leaving requests younger than the grace period to
+# queueonboarding, and queue at most this many per sweep.
+ONBOARDING_SWEEP_MINUTES = 10
+ONBOARDING_SWEEP_GRACE_MINUTES = 5
+ONBOARDING_SWEEP_LIMIT = 500
+
+
+@scheduler_fn.on_schedule(schedule=f"every {ONBOARDING_SWEEP_MINUTES} minutes")
+def sweeponboardingrequests(event: scheduler_fn.ScheduledEvent) -> None:
+    """Create the onboarding tasks that queueonboarding failed to create."""
+    if not DEFER_ONBOARDING_TASKS.value:
+        return
+    from firebase_admin import firestore
+    from google.cloud.firestore_v1.base_query import FieldFilter
+
+    cutoff = datetime.now(timezone.utc) - timedelta(minutes=ONBOARDING_SWEEP_GRACE_MINUTES)
+    pending = (
+        firestore.client(app=get_app())
+        .collection("user_info")
+        .where(filter=FieldFilter("onboarding_requested", "<", cutoff))
+        .limit(ONBOARDING_SWEEP_LIMIT)
+    )
+    queued, failed = 0, 0
+    for doc in pending.stream():
+        try:
+            queue_requested_onboarding(doc.reference, doc.get("onboarding_requested"))
+        except Exception as error:
+            # Leave the request for the next sweep.
+            failed += 1
+            print(f"Unable to queue onboarding for user {doc.id}.", error)
+        else:
+            queued += 1
+    if queued or failed:
+        print(f"Queued {queued} missed onboarding requests. {failed} failed.")
+
+
+def enqueue_onboarding(uid: str, task_id: str | None = None) -> None:
+    """Queue a task for scheduleonboarding to add an onboarding event to the user's
+    calendar in a minute.
+
+    Params:
+        task_id: If set, the task is named this, and isn't created again if a task with
+            that name already exists.
+    """
+    import google.api_core.exceptions
+    import google.cloud.tasks_v2
+
+    tasks_client = get_tasks_client()
+    task_queue = tasks_client.queue_path(
+        params.PROJECT_ID.value, options.SupportedRegion.US_CENTRAL1, "scheduleonboarding"
+    )
+    target_uri = get_function_url("scheduleonboarding")
+    calendar_task = google.cloud.tasks_v2.Task(
+        http_request={
+            "http_method": google.cloud.tasks_v2.HttpMethod.POST,
+            "url": target_uri,
+            "headers": {"Content-type": "application/json"},
+            "body": json.dumps({"data": {"uid": uid}}).encode(),
+        },
+        schedule_time=datetime.now() + timedelta(minutes=1),
+    )
+    if task_id is not None:
+        calendar_task.name = f"{task_queue}/tasks/{task_id}"
+    try:
+        tasks_client.create_task(parent=task_queue, task=calendar_task)
+    except google.api_core.exceptions.AlreadyExists:
+        print(f"Onboarding task {task_id} was already created.")
+
+
+@functools.cache
+def get_calendar_client():
+    """Build a Calendar API client from the discovery document bundled with the client
+    library on first use, then reuse it for the life of the instance.
+
+    The client has no credentials of its own. Pass each request an http object with the
+    user's credentials instead.
+    """
+    import googleapiclient.discovery
+    import httplib2
+
+    return googleapiclient.discovery.build(
+        "calendar", "v3", http=httplib2.Http(), static_discovery=True
+    )
+
+
 # [START scheduleonboarding]
 @tasks_fn.on_task_dispatched()
 def scheduleonboarding(request: tasks_fn.CallableRequest) -> https_fn.Response:
@@ -73,6 +213,11 @@ def scheduleonboarding(request: tasks_fn.CallableRequest) -> https_fn.Response:
 
     Retrieves and deletes the access token that was saved to Cloud Firestore.
     """
+    from firebase_admin import auth, firestore
+    import google.cloud.firestore
+    import google.oauth2.credentials
+    import google_auth_httplib2
+    import httplib2
 
     if "uid" not in request.data:
         return https_fn.Response(
@@ -80,30 +225,35 @@ def scheduleonboarding(request: tasks_fn.CallableRequest) -> https_fn.Response:
         )
     uid = request.data["uid"]
 
-    user_record: auth.UserRecord = auth.get_user(uid)
+    user_record: auth.UserRecord = auth.get_user(uid, app=get_app())
     if user_record.email is None:
         return https_fn.Response(
             status=https_fn.FunctionsErrorCode.INVALID_ARGUMENT,
             response="No email address on record.",
         )
 
-    firestore_client: google.cloud.firestore.Client = firestore.client()
-    user_info = firestore_client.collection("user_info").document(uid).get().to_dict()
-    if not isinstance(user_info, dict) or "calendar_access_token" not in user_info:
+    firestore_client: google.cloud.firestore.Client = firestore.client(app=get_app())
+
+    @firestore.transactional
+    def take_access_token(transaction) -> str | None:
+        """Read and delete the access token in one transaction."""
+        doc_ref = firestore_client.collection("user_info").document(uid)
+        user_info = doc_ref.get(transaction=transaction).to_dict()
+        if not isinstance(user_info, dict) or "calendar_access_token" not in user_info:
+            return None
+        transaction.update(doc_ref, {"calendar_access_token": google.cloud.firestore.DELETE_FIELD})
+        return user_info["calendar_access_token"]
+
+    calendar_access_token = take_access_token(firestore_client.transaction())
+    if calendar_access_token is None:
         return https_fn.Response(
             status=https_fn.FunctionsErrorCode.PERMISSION_DENIED,
             response="No Google OAuth token found.",
         )
-    calendar_access_token = user_info["calendar_access_token"]
-    firestore_client.collection("user_info").document(uid).update(
-        {"calendar_access_token": google.cloud.firestore.DELETE_FIELD}
-    )
 
     google_credentials = google.oauth2.credentials.Credentials(token=calendar_access_token)
 
-    calendar_client = googleapiclient.discovery.build(
-        "calendar", "v3", credentials=google_credentials
-    )
+    calendar_client = get_calendar_client()
     calendar_event = {
         "summary": "Onboarding with ExampleCo",
         "location": "Video call",
@@ -118,15 +268,32 @@ def scheduleonboarding(request: tasks_fn.CallableRequest) -> https_fn.Response:
         },
         "attendees": [{"email": user_record.email}, {"email": "onboarding@example.com"}],
     }
-    calendar_client.events().insert(calendarId="primary", body=calendar_event).execute()
+    # The client is shared, so send the request with this user's credentials.
+    calendar_client.events().insert(calendarId="primary", body=calendar_event).execute(
+        http=google_auth_httplib2.AuthorizedHttp(google_credentials, http=httplib2.Http())
+    )
 
     return https_fn.Response("Success")
 # [END scheduleonboarding]
 
 
+# How long a resolved function URL is reused, and how long a failed lookup is remembered
+# before it's tried again.
+FUNCTION_URL_TTL_SECONDS = 60 * 60
+FUNCTION_URL_FAILURE_TTL_SECONDS = 30
+
+# (name, location) -> (expiry, URL or None if the lookup failed)
+function_urls: dict[tuple[str, str], tuple[float, str | None]] = {}
+function_urls_lock = threading.Lock()
+
+
 def get_function_url(name: str, location: str = options.SupportedRegion.US_CENTRAL1) -> str:
     """Get the URL of a given v2 cloud function.
 
+    URLs are cached for the life of the instance, so at most one lookup is made per
+    function per hour. To skip the lookup entirely, set the URL in a
+    `FUNCTION_URL_<NAME>` environment variable, for example in your .env file.
+
     Params:
         name: the function's name
         location: the function's location
@@ -134,15 +301,63 @@ def get_function_url(name: str, location: str = options.SupportedRegion.US_CENTR
     Returns:
         The URL of the function
     """
+    key = (name, str(location))
+    with function_urls_lock:
+        expiry, function_url = function_urls.get(key, (0.0, None))
+        if expiry <= time.monotonic():
+            function_url = os.environ.get(f"FUNCTION_URL_{name.upper()}")
+            if function_url is None:
+                function_url = lookup_function_url(name, str(location))
+            ttl = FUNCTION_URL_TTL_SECONDS if function_url else FUNCTION_URL_FAILURE_TTL_SECONDS
+            function_urls[key] = (time.monotonic() + ttl, function_url)
+    if function_url is None:
+        raise LookupError(f"Unable to find the URL of function {name} in {location}.")
+    return function_url
+
+
+@functools.cache
+def get_authorized_session():
+    """Create an authorized session on first use, then reuse its credentials and
+    connections for the life of the instance."""
+    import google.auth
+    from google.auth.transport.requests import AuthorizedSession
+
     credentials, project_id = google.auth.default(
         scopes=["https://www.googleapis.com/auth/cloud-platform"]
     )
-    authed_session = google.auth.transport.requests.AuthorizedSession(credentials)
+    return AuthorizedSession(credentials), project_id
+
+
+def lookup_function_url(name: str, location: str) -> str | None:
+    """Look up the URL of a v2 cloud function with the Cloud Functions API."""
+    authed_session, project_id = get_authorized_session()
     url = (
         "https://cloudfunctions.googleapis.com/v2beta/"
         + f"projects/{project_id}/locations/{location}/functions/{name}"
     )
-    response = authed_session.get(url)
-    data = response.json()
-    function_url = data["serviceConfig"]["uri"]
-    return function_url
+    try:
+        response = authed_session.get(url, timeout=10)
+        response.raise_for_status()
+        return response.json()["serviceConfig"]["uri"]
+    except Exception as error:
+        print(f"Unable to look up the URL of function {name}.", error)
+        return None
+
+
+def warm_function_urls(*names: str) -> None:
+    """Resolve function URLs in the background, so the first request doesn't wait on it."""
+
+    def resolve() -> None:
+        for name in names:
+            try:
+                get_function_url(name)
+            except LookupError:
+                pass  # Already logged. The next call will try again.
+
+    threading.Thread(target=resolve, daemon=True).start()
+
+
+# Resolve the task function's URL as soon as an instance starts, rather than during the
+# first sign-up. K_SERVICE is only set when running in Cloud Functions, not during deploys.
+if "K_SERVICE" in os.environ:
+    warm_function_urls("scheduleonboarding")
@@ -12,8 +12,16 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import bisect
+import dataclasses
+import ipaddress
+import socket
+import threading
+import time
+from typing import Callable, NamedTuple
+
 from firebase_admin import auth, firestore, initialize_app
-from firebase_functions import identity_fn, https_fn
+from firebase_functions import identity_fn, https_fn, params
 
 import google.cloud.firestore
 
@@ -127,8 +135,136 @@ def markverified(
 # [END trustfacebook]
 
 
+# Banned IP addresses and CIDR ranges, one per line, in a Cloud Storage object
+# ("gs://bucket/path") or a file deployed with the functions. Lines starting with # are
+# ignored.
+IP_BLOCKLIST = params.StringParam("IP_BLOCKLIST", default="")
+
+# How often to check the blocklist for changes.
+IP_BLOCKLIST_RELOAD_SECONDS = 5 * 60
+
+
+class IpRanges(NamedTuple):
+    """Sorted, non-overlapping ranges of addresses, as integers, for one IP version."""
+
+    starts: list[int]
+    ends: list[int]
+
+    @classmethod
+    def from_networks(cls, networks) -> "IpRanges":
+        starts, ends = [], []
+        for network in sorted(networks, key=lambda network: int(network.network_address)):
+            start = int(network.network_address)
+            end = int(network.broadcast_address)
+            if starts and start <= ends[-1] + 1:
+                ends[-1] = max(ends[-1], end)
+            else:
+                starts.append(start)
+                ends.append(end)
+        return cls(starts, ends)
+
+    def contains(self, address: int) -> bool:
+        i = bisect.bisect_right(self.starts, address) - 1
+        return i >= 0 and address <= self.ends[i]
+
+
+class IpBlocklist:
+    """Banned IPv4 and IPv6 ranges, checked with a binary search.
+
+    The ranges are reloaded in the background when the blocklist changes. A reload swaps
+    in the new ranges all at once, so checks never see a partly loaded list.
+    """
+
+    def __init__(self):
+        self.ranges = (IpRanges([], []), IpRanges([], []))
+        self.source = None
+        self.version = None
+        self.checked_at = 0.0
+        self.reload_lock = threading.Lock()
+
+    def contains(self, ip_address: str) -> bool:
+        if time.monotonic() - self.checked_at > IP_BLOCKLIST_RELOAD_SECONDS:
+            self.checked_at = time.monotonic()
+            if self.source is None:
+                self.reload(wait=True)  # Wait for the first load.
+            else:
+                threading.Thread(target=self.reload, daemon=True).start()
+        ipv4, ipv6 = self.ranges
+        try:
+            return ipv4.contains(
+                int.from_bytes(socket.inet_pton(socket.AF_INET, ip_address), "big")
+            )
+        except OSError:
+            pass
+        try:
+            return ipv6.contains(
+                int.from_bytes(socket.inet_pton(socket.AF_INET6, ip_address), "big")
+            )
+        except OSError:
+            return False
+
+    def reload(self, wait: bool = False) -> None:
+        """Load the blocklist from IP_BLOCKLIST, if it changed since it was last loaded.
+
+        Params:
+            wait: Wait for a reload that's already running, instead of returning.
+        """
+        if not self.reload_lock.acquire(blocking=wait):
+            return  # Already reloading.
+        try:
+            self.source = IP_BLOCKLIST.value
+            if self.source == "":
+                return
+            if self.source.startswith("gs://"):
+                from firebase_admin import storage
+
+                bucket_name, _, path = self.source.removeprefix("gs://").partition("/")
+                blob = storage.bucket(bucket_name).get_blob(path)
+                if blob is None:
+                    print(f"IP blocklist {self.source} not found.")
+                    return
+                if blob.generation == self.version:
+                    return
+                version, lines = blob.generation, blob.download_as_text().splitlines()
+            else:
+                with open(self.source) as blocklist_file:
+                    lines = blocklist_file.read().splitlines()
+                version = hash(tuple(lines))
+                if version == self.version:
+                    return
+            self.load(lines)
+            self.version = version
+        except Exception as error:
+            # Keep using the blocklist that's already loaded.
+            print(f"Unable to reload IP blocklist {self.source}.", error)
+        finally:
+            self.reload_lock.release()
+
+    def load(self, lines: list[str]) -> None:
+        networks = {4: [], 6: []}
+        invalid = 0
+        for line in lines:
+            line = line.strip()
+            if line == "" or line.startswith("#"):
+                continue
+            try:
+                network = ipaddress.ip_network(line, strict=False)
+            except ValueError:
+                invalid += 1
+                continue
+            networks[network.version].append(network)
+        self.ranges = (IpRanges.from_networks(networks[4]), IpRanges.from_networks(networks[6]))
+        print(
+            f"Loaded {len(networks[4])} IPv4 and {len(networks[6])} IPv6 banned ranges"
+            f" from {self.source}. Skipped {invalid} invalid lines."
+        )
+
+
+ip_blocklist = IpBlocklist()
+
+
 def is_suspicious(ip_address):
-    return True
+    return ip_blocklist.contains(ip_address)
 
 
 # [START ipban]
@@ -205,6 +341,86 @@ def sanitizeprofilephoto(
 # [END sanitizeprofilephoto]
 
 
+# Restart the banned emails listener if its stream stops, at most this often.
+BANNED_EMAILS_RETRY_SECONDS = 30
+
+# Also restart it this often, in case its stream stopped without an error. Each restart
+# reads the whole collection, so this is much longer than the listener's usual lifetime.
+BANNED_EMAILS_RELISTEN_SECONDS = 6 * 60 * 60
+
+
+class BannedEmails:
+    """The IDs of the documents in a Firestore collection of banned email addresses, kept
+    in memory and up to date with a snapshot listener.
+
+    The listener starts on the first check, and is restarted if its stream stops or it's
+    older than BANNED_EMAILS_RELISTEN_SECONDS. Until the first listener's first snapshot
+    arrives, checks read the email's document directly. While a restarted listener loads,
+    checks keep using the emails the last one loaded.
+    """
+
+    def __init__(self, collection: str):
+        self.collection = collection
+        self.emails: set[str] = set()
+        self.ready = threading.Event()
+        self.watch = None
+        self.watch_lock = threading.Lock()
+        # When the current listener started, whether its first snapshot is still to come,
+        # and the read time of the last snapshot.
+        self.started_at = 0.0
+        self.loading = False
+        self.read_time = None
+
+    def contains(self, email: str) -> bool:
+        if self.needs_restart():
+            self.listen()
+        if self.ready.is_set():
+            return email in self.emails
+        if email == "":
+            return False
+        firestore_client: google.cloud.firestore.Client = firestore.client()
+        return firestore_client.collection(self.collection).document(email).get().exists
+
+    def needs_restart(self) -> bool:
+        watch = self.watch
+        age = time.monotonic() - self.started_at
+        if watch is None:
+            return True
+        if not watch.is_active:
+            return age > BANNED_EMAILS_RETRY_SECONDS
+        return age > BANNED_EMAILS_RELISTEN_SECONDS
+
+    def listen(self) -> None:
+        with self.watch_lock:
+            if not self.needs_restart():
+                return
+            if self.watch is not None:
+                print(f"Restarting the banned emails listener. Last snapshot: {self.read_time}")
+                self.watch.unsubscribe()
+            self.started_at = time.monotonic()
+            self.loading = True
+            firestore_client: google.cloud.firestore.Client = firestore.client()
+            self.watch = firestore_client.collection(self.collection).on_snapshot(self.on_snapshot)
+
+    def on_snapshot(self, docs, changes, read_time) -> None:
+        self.read_time = read_time
+        if self.loading:
+            # A listener's first snapshot has every banned email. Swap them in all at once.
+            self.emails = {doc.id for doc in docs}
+            self.loading = False
+            print(f"Loaded {len(self.emails)} banned emails.")
+            self.ready.set()
+            return
+        for change in changes:
+            if change.type.name == "REMOVED":
+                self.emails.discard(change.document.id)
+            else:
+                self.emails.add(change.document.id)
+
+
+banned_emails = BannedEmails("banned")
+
+
 # [START v2CheckForBan]
 # [START v2beforeSignInFunctionTrigger]
 # Block account sign in with any banned account.
@@ -219,14 +435,14 @@ def checkforban(
     # [END v2readEmailData]
 
     # [START v2documentGet]
-    # Obtain a document in Firestore of the banned email address.
-    firestore_client: google.cloud.firestore.Client = firestore.client()
-    doc = firestore_client.collection("banned").document(email).get()
+    # Check for a document in Firestore of the banned email address. The banned emails
+    # are kept in memory, so most sign-ins don't wait on a Firestore read.
+    banned = banned_emails.contains(email)
     # [END v2documentGet]
 
     # [START v2bannedHttpsError]
     # Checking that the document exists for the email address.
-    if doc.exists:
+    if banned:
         # Throw an HttpsError so that Firebase Auth rejects the account sign in.
         raise https_fn.HttpsError(
             code=https_fn.FunctionsErrorCode.INVALID_ARGUMENT,
@@ -234,3 +450,97 @@ def checkforban(
         )
     # [END v2bannedHttpsError]
 # [END v2CheckForBan]
+
+
+# Firebase Auth calls only one blocking function per event, so the checks above can't all
+# be deployed at once. These two functions run them in sequence instead. Deploy them in
+# place of the individual functions.
+
+
+class Rule(NamedTuple):
+    """A blocking check, run by beforeusercreated or beforeusersignedin."""
+
+    name: str
+    check: Callable[[identity_fn.AuthBlockingEvent], dict | None]
+    # Rules run from cheapest to most expensive, so a rejection skips the expensive ones:
+    # 0 for checks of the event itself, 1 for in-memory lookups, and 2 for network
+    # requests or ML models.
+    cost: int
+
+
+# The undecorated handlers above, in the order they run within each cost.
+CREATE_RULES = sorted(
+    [
+        Rule("validatenewuser", validatenewuser.__wrapped__, 0),
+        Rule("markverified", markverified.__wrapped__, 0),
+        Rule("requireverified", requireverified.__wrapped__, 0),
+        Rule("setdefaultname", setdefaultname.__wrapped__, 0),
+        Rule("setemployeeid", setemployeeid.__wrapped__, 0),
+        Rule("sanitizeprofilephoto", sanitizeprofilephoto.__wrapped__, 2),
+    ],
+    key=lambda rule: rule.cost,
+)
+SIGN_IN_RULES = sorted(
+    [
+        Rule("copyclaimstosession", copyclaimstosession.__wrapped__, 0),
+        Rule("logip", logip.__wrapped__, 0),
+        Rule("ipban", ipban.__wrapped__, 1),
+        Rule("checkforban", checkforban.__wrapped__, 1),
+    ],
+    key=lambda rule: rule.cost,
+)
+
+# Response fields that later rules should see in the event's user record.
+USER_RECORD_FIELDS = ("display_name", "disabled", "email_verified", "photo_url", "custom_claims")
+
+
+def run_rules(rules: list[Rule], event: identity_fn.AuthBlockingEvent) -> dict | None:
+    """Run rules in order and merge their responses.
+
+    The first rule to raise an HttpsError rejects the event, and the remaining rules
+    don't run. Later rules see the user record as updated by earlier responses. When
+    two responses set the same field, the later one wins, except for claims, which are
+    merged. How long each rule took is logged.
+
+    Returns:
+        The merged response, or None if no rule changed anything.
+    """
+    merged: dict = {}
+    timings = []
+    outcome = "allowed"
+    try:
+        for rule in rules:
+            start = time.perf_counter()
+            try:
+                response = rule.check(event)
+            except https_fn.HttpsError:
+                outcome = f"rejected by {rule.name}"
+                raise
+            finally:
+                timings.append(f"{rule.name} {(time.perf_counter() - start) * 1000:.2f} ms")
+            if not response:
+                continue
+            for field, value in response.items():
+                if field in ("custom_claims", "session_claims") and field in merged:
+                    merged[field] = merged[field] | value
+                else:
+                    merged[field] = value
+            updates = {field: merged[field] for field in USER_RECORD_FIELDS if field in merged}
+            event = dataclasses.replace(event, data=dataclasses.replace(event.data, **updates))
+    finally:
+        print(f"Blocking rules {outcome}: {', '.join(timings)}")
+    return merged or None
+
+
+@identity_fn.before_user_created()
+def beforeusercreated(
+    event: identity_fn.AuthBlockingEvent,
+) -> identity_fn.BeforeCreateResponse | None:
+    return run_rules(CREATE_RULES, event)
+
+
+@identity_fn.before_user_signed_in()
+def beforeusersignedin(
+    event: identity_fn.AuthBlockingEvent,
+) -> identity_fn.BeforeSignInResponse | None:
+    return run_rules(SIGN_IN_RULES, event)
@@ -14,47 +14,115 @@
 
 # [START all]
 # [START import]
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import json
+
 # The Cloud Functions for Firebase SDK to set up triggers and logging.
 from firebase_functions import remote_config_fn
 
 # The Firebase Admin SDK to obtain access tokens.
 import firebase_admin
+# [END import]
 
-app = firebase_admin.initialize_app()
 
-import deepdiff
-import requests
-# [END import]
+@functools.cache
+def get_app() -> firebase_admin.App:
+    """Initialize the Admin SDK on first use, then reuse it for the life of the instance."""
+    return firebase_admin.initialize_app()
+
+
+@functools.cache
+def get_http_session():
+    """Create an HTTP session on first use, then keep its connections to the Remote Config
+    API alive across invocations. requests is imported here, so it isn't loaded on every
+    cold start."""
+    import requests
+
+    return requests.Session()
 
 
 # [START showconfigdiff]
 @remote_config_fn.on_config_updated()
 def showconfigdiff(event: remote_config_fn.CloudEvent[remote_config_fn.ConfigUpdateData]) -> None:
     """Log the diff of the most recent Remote Config template change."""
+    app = get_app()
 
     # Obtain an access token from the Admin SDK
     access_token = app.credential.get_access_token().access_token
 
     # Get the version number from the event object
     current_version = int(event.data.version_number)
+    if current_version < 2:
+        print("This is the first template version. There's nothing to compare it to.")
+        return
 
-    # Figure out the differences between templates
+    # Fetch both templates at once
     remote_config_api = (
         "https://firebaseremoteconfig.googleapis.com/v1/" f"projects/{app.project_id}/remoteConfig"
     )
-    current_template = requests.get(
-        remote_config_api,
-        params={"versionNumber": current_version},
-        headers={"Authorization": f"Bearer {access_token}"},
-    )
-    previous_template = requests.get(
-        remote_config_api,
-        params={"versionNumber": current_version - 1},
-        headers={"Authorization": f"Bearer {access_token}"},
-    )
-    diff = deepdiff.DeepDiff(previous_template, current_template)
+
+    def get_template(version_number: int) -> dict:
+        response = get_http_session().get(
+            remote_config_api,
+            params={"versionNumber": version_number},
+            headers={"Authorization": f"Bearer {access_token}"},
+            timeout=(5, 30),
+        )
+        response.raise_for_status()
+        return response.json()
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        previous_template, current_template = executor.map(
+            get_template, [current_version - 1, current_version]
+        )
+
+    # Figure out the differences between templates
+    patch = diff_templates(previous_template, current_template)
 
     # Log the difference
-    print(diff.pretty())
+    print(json.dumps(patch, separators=(",", ":")))
 # [END showconfigdiff]
+
+
+def diff_templates(previous: dict, current: dict) -> list[dict]:
+    """Compare two Remote Config templates by parameter, condition and parameter group name.
+
+    Each entry is compared as a whole, so the diff takes time linear in the size of the
+    templates. The order of conditions isn't compared.
+
+    Returns:
+        A JSON Patch (RFC 6902) that turns the previous template into the current one.
+        Conditions are addressed by name instead of by index, like the other sections.
+    """
+    patch = []
+    for section in ("parameters", "conditions", "parameterGroups"):
+        before = by_name(previous.get(section))
+        after = by_name(current.get(section))
+        for name, value in before.items():
+            path = f"/{section}/{escape_pointer(name)}"
+            if name not in after:
+                patch.append({"op": "remove", "path": path})
+            elif after[name] != value:
+                patch.append({"op": "replace", "path": path, "value": after[name]})
+        for name, value in after.items():
+            if name not in before:
+                path = f"/{section}/{escape_pointer(name)}"
+                patch.append({"op": "add", "path": path, "value": value})
+    return patch
+
+
+def by_name(section: dict | list | None) -> dict:
+    """Key a template section by name. Conditions are a list; the other sections are
+    already keyed by name."""
+    if section is None:
+        return {}
+    if isinstance(section, list):
+        return {entry["name"]: entry for entry in section}
+    return section
+
+
+def escape_pointer(name: str) -> str:
+    """Escape a name for use in a JSON Pointer."""
+    return name.replace("~", "~0").replace("/", "~1")
 # [END all]
@@ -0,0 +1,139 @@
+"""Utility to compare savegoogletoken's latency with and without DEFER_ONBOARDING_TASKS,
+against local stand-ins for Firestore, the Cloud Functions API and Cloud Tasks that take a
+set time to respond."""
+
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import contextlib
+import io
+import os
+import statistics
+import sys
+import time
+import types
+
+
+class StandInDocument:
+    """Takes as long to write as a Firestore document."""
+
+    latency = 0.0
+
+    def set(self, data: dict, merge: bool = False) -> None:
+        time.sleep(self.latency)
+
+
+class StandInFirestore:
+    def collection(self, name: str):
+        return types.SimpleNamespace(document=lambda doc_id: StandInDocument())
+
+
+class StandInTasksClient:
+    """Takes as long to create a task as Cloud Tasks, and counts the tasks created."""
+
+    latency = 0.0
+
+    def __init__(self):
+        self.tasks_created = 0
+
+    def queue_path(self, project: str, location: str, queue: str) -> str:
+        return f"projects/{project}/locations/{location}/queues/{queue}"
+
+    def create_task(self, parent: str, task) -> None:
+        time.sleep(self.latency)
+        self.tasks_created += 1
+
+
+def sign_up_event(uid: str):
+    """An event like the one Auth sends when someone signs up with Google."""
+    return types.SimpleNamespace(
+        credential=types.SimpleNamespace(provider_id="google.com", access_token="token"),
+        data=types.SimpleNamespace(uid=uid),
+    )
+
+
+def time_sign_ups(savegoogletoken, sign_ups: int) -> list[float]:
+    times = []
+    with contextlib.redirect_stdout(io.StringIO()):  # The function logs every sign-up.
+        for i in range(sign_ups):
+            start = time.perf_counter()
+            savegoogletoken(sign_up_event(f"user{i}"))
+            times.append(time.perf_counter() - start)
+    return times
+
+
+def summarize(times: list[float]) -> str:
+    p50, p99 = (statistics.quantiles(times, n=100)[i] for i in (49, 98))
+    return f"p50 {p50 * 1000:7.2f} ms, p99 {p99 * 1000:7.2f} ms"
+
+
+if __name__ == "__main__":
+    import argparse
+
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument(
+        "--sign-ups", "-n", type=int, default=200, help="number of sign-ups to time per mode"
+    )
+    argparser.add_argument(
+        "--firestore-ms", type=float, default=10, help="milliseconds a Firestore write takes"
+    )
+    argparser.add_argument(
+        "--tasks-ms", type=float, default=40, help="milliseconds creating a task takes"
+    )
+    argparser.add_argument(
+        "--lookup-ms",
+        type=float,
+        default=150,
+        help="milliseconds looking up a function's URL with the Cloud Functions API takes",
+    )
+    argparser.add_argument(
+        "functions_dir",
+        nargs="?",
+        default="post-signup-event/functions",
+        help="the functions directory whose main.py to benchmark",
+    )
+    args = argparser.parse_args()
+
+    # The function decorators need a project config to import outside of the emulator.
+    os.environ.setdefault("FIREBASE_CONFIG", '{"projectId": "demo-signupbench"}')
+    os.environ.setdefault("GCLOUD_PROJECT", "demo-signupbench")
+    os.environ["FUNCTION_TARGET"] = "savegoogletoken"
+    sys.path.insert(0, args.functions_dir)
+    from firebase_admin import firestore
+    import main
+
+    StandInDocument.latency = args.firestore_ms / 1000
+    firestore.client = lambda app=None: StandInFirestore()
+    StandInTasksClient.latency = args.tasks_ms / 1000
+    tasks_client = StandInTasksClient()
+    main.get_tasks_client = lambda: tasks_client
+    url_lookups = 0
+
+    def lookup_function_url(name: str, location: str) -> str:
+        global url_lookups
+        url_lookups += 1
+        time.sleep(args.lookup_ms / 1000)
+        return f"https://{location}-demo-signupbench.cloudfunctions.net/{name}"
+
+    main.lookup_function_url = lookup_function_url
+
+    for defer in (False, True):
+        os.environ["DEFER_ONBOARDING_TASKS"] = str(defer).lower()
+        main.function_urls.clear()
+        url_lookups, tasks_client.tasks_created = 0, 0
+        times = time_sign_ups(main.savegoogletoken.__wrapped__, args.sign_ups)
+        print(
+            f"DEFER_ONBOARDING_TASKS={str(defer).lower():<5}: {summarize(times)},"
+            f" {tasks_client.tasks_created} tasks created, {url_lookups} URL lookups"
+        )
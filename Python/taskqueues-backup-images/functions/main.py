@@ -14,22 +14,27 @@
 
 # [START v2imports]
 # Dependencies for task queue functions.
-from google.cloud import tasks_v2
-import requests
 from firebase_functions.options import RetryConfig, RateLimits, SupportedRegion
 
 # Dependencies for image backup.
+import collections
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+import functools
+import hashlib
 import json
+import os
 import pathlib
+import random
+import threading
+import time
 from urllib.parse import urlparse
-from firebase_admin import initialize_app, storage, functions
+import firebase_admin
 from firebase_functions import https_fn, tasks_fn, params
-import google.auth
-from google.auth.transport.requests import AuthorizedSession
-# [END v2imports]
 
-app = initialize_app()
+# The Admin SDK's storage and task queue modules, requests and google.auth are imported
+# on first use, so they aren't loaded on every cold start.
+# [END v2imports]
 
 BACKUP_START_DATE = datetime(1995, 6, 17)
 BACKUP_COUNT = params.IntParam("BACKUP_COUNT", default=100).value
@@ -38,34 +43,223 @@ BACKUP_BUCKET = params.StringParam(
     "BACKUP_BUCKET", input=params.ResourceInput(type=params.ResourceType.STORAGE_BUCKET)
 ).value
 NASA_API_KEY = params.StringParam("NASA_API_KEY").value
+# Back up this many consecutive days in each task. Ranges share one APOD API request and
+# one task dispatch, instead of paying for them once per day.
+BACKUP_DAYS_PER_TASK = params.IntParam("BACKUP_DAYS_PER_TASK", default=1).value
+
+# (connect, read) timeouts in seconds for requests to the APOD API and image hosts.
+HTTP_TIMEOUT = (5, 30)
+
+# Images are streamed from the image host to Cloud Storage in chunks of these sizes, so
+# only about one upload chunk is held in memory at a time. The upload chunk size must be
+# a multiple of 256 KiB.
+DOWNLOAD_CHUNK_BYTES = 256 * 1024
+UPLOAD_CHUNK_BYTES = 8 * 256 * 1024
+
+# Enqueue this many tasks at once. The Admin SDK keeps up to 10 connections per host
+# alive, so more threads than that would open throwaway connections.
+ENQUEUE_WORKERS = 10
+ENQUEUE_MAX_ATTEMPTS = 5
+
+# Back up this many days of a range at once. Each one holds a connection to the image host
+# and an upload chunk in memory.
+RANGE_WORKERS = 8
+
+
+@functools.cache
+def get_app() -> firebase_admin.App:
+    """Initialize the Admin SDK on first use, then reuse it for the life of the instance."""
+    return firebase_admin.initialize_app()
+
+
+@functools.cache
+def get_http_session():
+    """Create an HTTP session on first use, then keep its connections to the APOD API and
+    image hosts alive across invocations."""
+    import requests
+    import requests.adapters
+
+    session = requests.Session()
+    # Keep a connection per concurrent dispatch to each host.
+    adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=10)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
 
 
 # [START v2TaskFunctionSetup]
 @tasks_fn.on_task_dispatched(
     retry_config=RetryConfig(max_attempts=5, min_backoff_seconds=60),
     rate_limits=RateLimits(max_concurrent_dispatches=10),
+    timeout_sec=1800,  # Long enough for a range of days. See BACKUP_DAYS_PER_TASK.
 )
-def backupapod(req: tasks_fn.CallableRequest) -> str:
+def backupapod(req: tasks_fn.CallableRequest) -> str | dict[str, str]:
     """Grabs Astronomy Photo of the Day (APOD) using NASA's API."""
 # [END v2TaskFunctionSetup]
+    if "start_date" in req.data and "end_date" in req.data:
+        return backup_apod_range(req.data["start_date"], req.data["end_date"])
     try:
         date = req.data["date"]
     except KeyError:
         raise https_fn.HttpsError(
             code=https_fn.FunctionsErrorCode.INVALID_ARGUMENT,
-            message="Invalid payload. Must include date.",
+            message="Invalid payload. Must include date, or start_date and end_date.",
+        )
+
+    return backup_apod(date)
+
+
+# Dates this instance has already backed up.
+saved_dates: set[str] = set()
+
+# date -> the fields of the APOD API response that backups use.
+apod_metadata: dict[str, dict] = {}
+
+
+def backup_apod(date: str) -> str:
+    """Back up the APOD for a date, unless it's already backed up or isn't an image.
+
+    Retried tasks find the image or the APOD metadata saved by an earlier attempt, so they
+    don't spend APOD API quota on it again.
+    """
+    from firebase_admin import storage
+
+    bucket = storage.bucket(BACKUP_BUCKET, app=get_app())
+    if date in saved_dates or any(
+        bucket.list_blobs(prefix=f"apod/{date}.", max_results=1, fields="items(name)")
+    ):
+        saved_dates.add(date)
+        print(f"APOD for {date} is already backed up.")
+        return f"APOD for {date} is already backed up."
+    return save_apod(bucket, date)
+
+
+def save_apod(bucket, date: str) -> str:
+    """Stream the APOD image for a date into Cloud Storage, unless it isn't an image."""
+    apod = get_apod_metadata(bucket, date)
+    if apod is None:
+        return "No APOD today."
+    if apod.get("media_type") != "image":
+        print(f"APOD for {date} is a {apod.get('media_type')}, not an image. Skipping.")
+        return f"APOD for {date} is not an image."
+    pic_url = apod.get("hdurl") or apod["url"]
+
+    print(f"Got URL {pic_url} from NASA API for date {date}. Fetching...")
+    with get_http_session().get(pic_url, stream=True, timeout=HTTP_TIMEOUT) as pic_resp:
+        if not pic_resp.ok:
+            print(f"Request for {pic_url} failed with response {pic_resp.status_code}")
+            raise https_fn.HttpsError(
+                code=https_fn.FunctionsErrorCode.UNAVAILABLE, message="Image not available."
+            )
+        pic_type = pic_resp.headers.get("Content-Type")
+        if pic_type is None:
+            pic_type = "image/jpeg"
+
+        print("Streaming to Cloud Storage")
+        ext = pathlib.PurePosixPath(urlparse(pic_url).path).suffix
+        pic_blob = bucket.blob(f"apod/{date}{ext}", chunk_size=UPLOAD_CHUNK_BYTES)
+        try:
+            with pic_blob.open("wb", content_type=pic_type) as pic_file:
+                for chunk in pic_resp.iter_content(chunk_size=DOWNLOAD_CHUNK_BYTES):
+                    pic_file.write(chunk)
+        except:
+            raise https_fn.HttpsError(
+                code=https_fn.FunctionsErrorCode.INTERNAL, message="Uh-oh. Something broke."
+            )
+
+    saved_dates.add(date)
+    print(f"Saved {pic_url}")
+    return f"Saved {pic_url}"
+
+
+def backup_apod_range(start_date: str, end_date: str) -> dict[str, str]:
+    """Back up the APODs for each date from start_date to end_date, inclusive.
+
+    The metadata for the whole range comes from one APOD API request, and the images are
+    backed up a few at a time. If any date fails, the task fails after the rest are done,
+    so the retry only redoes the dates that aren't backed up yet.
+
+    Returns:
+        The result for each date.
+    """
+    from firebase_admin import storage
+    import google.api_core.exceptions
+    import requests
+
+    try:
+        dates = [
+            (datetime.fromisoformat(start_date) + timedelta(days=i)).isoformat()[:10]
+            for i in range(
+                (datetime.fromisoformat(end_date) - datetime.fromisoformat(start_date)).days + 1
+            )
+        ]
+    except ValueError:
+        raise https_fn.HttpsError(
+            code=https_fn.FunctionsErrorCode.INVALID_ARGUMENT,
+            message="Invalid payload. start_date and end_date must be YYYY-MM-DD.",
+        )
+    if not dates:
+        raise https_fn.HttpsError(
+            code=https_fn.FunctionsErrorCode.INVALID_ARGUMENT,
+            message="Invalid payload. start_date must not be after end_date.",
+        )
+
+    # One listing finds every date in the range that's already backed up.
+    bucket = storage.bucket(BACKUP_BUCKET, app=get_app())
+    saved_dates.update(
+        pathlib.PurePosixPath(blob.name).stem
+        for blob in bucket.list_blobs(
+            prefix="apod/",
+            start_offset=f"apod/{dates[0]}",
+            end_offset=f"apod/{dates[-1]}/",
+            fields="items(name),nextPageToken",
+        )
+    )
+    missing = [date for date in dates if date not in saved_dates and date not in apod_metadata]
+    if missing:
+        get_apod_range_metadata(missing[0], missing[-1])
+
+    def backup(date: str) -> str:
+        if date in saved_dates:
+            return f"APOD for {date} is already backed up."
+        if date not in apod_metadata:
+            return "No APOD today."
+        try:
+            return save_apod(bucket, date)
+        except https_fn.HttpsError as error:
+            return f"Failed: {error.message}"
+        except (requests.RequestException, google.api_core.exceptions.GoogleAPIError) as error:
+            # Report a failed download or upload with the date, instead of failing the
+            # whole range.
+            print(f"Unable to back up the APOD for {date}.", error)
+            return f"Failed: {error}"
+
+    with ThreadPoolExecutor(max_workers=RANGE_WORKERS) as executor:
+        results = dict(zip(dates, executor.map(backup, dates)))
+    print(f"Backed up APODs from {start_date} to {end_date}: {results}")
+
+    failed = [date for date, result in results.items() if result.startswith("Failed")]
+    if failed:
+        raise https_fn.HttpsError(
+            code=https_fn.FunctionsErrorCode.UNAVAILABLE,
+            message=f"Failed to back up {len(failed)} of {len(dates)} dates.",
+            details=results,
         )
+    return results
+
 
-    print(f"Requesting data from APOD API for date {date}")
-    api_resp = requests.get(
-        url="https://api.nasa.gov/planetary/apod", params={"date": date, "api_key": NASA_API_KEY}
+def get_apod_range_metadata(start_date: str, end_date: str) -> None:
+    """Get the APOD metadata for each date from start_date to end_date with one APOD API
+    request, and add it to this instance's cache. Dates without an APOD are left out."""
+    print(f"Requesting data from APOD API for dates {start_date} to {end_date}")
+    api_resp = get_http_session().get(
+        url="https://api.nasa.gov/planetary/apod",
+        params={"start_date": start_date, "end_date": end_date, "api_key": NASA_API_KEY},
+        timeout=HTTP_TIMEOUT,
     )
     if not api_resp.ok:
         print(f"Request to NASA APOD API failed with reponse {api_resp.status_code}")
         match api_resp.status_code:
-            case 404:  # APOD not published for the day. This is fine!
-                print("No APOD today.")
-                return "No APOD today."
             case 500:
                 raise https_fn.HttpsError(
                     code=https_fn.FunctionsErrorCode.UNAVAILABLE,
@@ -73,80 +267,222 @@ def backupapod(req: tasks_fn.CallableRequest) -> str:
                 )
             case _:
                 raise https_fn.HttpsError(
-                    code=https_fn.FunctionsErrorCode.INTERNAL, message="Uh-oh. Something broke."
+                    code=https_fn.FunctionsErrorCode.INTERNAL,
+                    message="Uh-oh. Something broke.",
                 )
-    apod = api_resp.json()
-    pic_url = apod["hdurl"]
+    for entry in api_resp.json():
+        apod_metadata[entry["date"]] = {
+            key: entry.get(key) for key in ("date", "media_type", "hdurl", "url")
+        }
 
-    print(f"Got URL {pic_url} from NASA API for date {date}. Fetching...")
-    pic_resp = requests.get(pic_url)
-    pic_type = pic_resp.headers.get("Content-Type")
-    if pic_type is None:
-        pic_type = "image/jpeg"
-
-    print("Uploading to Cloud Storage")
-    bucket = storage.bucket(BACKUP_BUCKET)
-    ext = pathlib.PurePosixPath(urlparse(pic_url).path).suffix
-    pic_blob = bucket.blob(f"apod/{date}{ext}")
+
+def get_apod_metadata(bucket, date: str) -> dict | None:
+    """Get the APOD metadata for a date from this instance's cache, the copy an earlier
+    attempt saved to Cloud Storage, or the APOD API, in that order.
+
+    Returns:
+        The metadata, or None if there's no APOD for the date.
+    """
+    import google.api_core.exceptions
+
+    if date in apod_metadata:
+        return apod_metadata[date]
+
+    metadata_blob = bucket.blob(f"apod_metadata/{date}.json")
     try:
-        pic_blob.upload_from_string(pic_resp.content, content_type=pic_type)
-    except:
-        raise https_fn.HttpsError(
-            code=https_fn.FunctionsErrorCode.INTERNAL, message="Uh-oh. Something broke."
+        apod = json.loads(metadata_blob.download_as_text())
+    except google.api_core.exceptions.NotFound:
+        print(f"Requesting data from APOD API for date {date}")
+        api_resp = get_http_session().get(
+            url="https://api.nasa.gov/planetary/apod",
+            params={"date": date, "api_key": NASA_API_KEY},
+            timeout=HTTP_TIMEOUT,
         )
+        if not api_resp.ok:
+            print(f"Request to NASA APOD API failed with reponse {api_resp.status_code}")
+            match api_resp.status_code:
+                case 404:  # APOD not published for the day. This is fine!
+                    print("No APOD today.")
+                    return None
+                case 500:
+                    raise https_fn.HttpsError(
+                        code=https_fn.FunctionsErrorCode.UNAVAILABLE,
+                        message="APOD API temporarily not available.",
+                    )
+                case _:
+                    raise https_fn.HttpsError(
+                        code=https_fn.FunctionsErrorCode.INTERNAL,
+                        message="Uh-oh. Something broke.",
+                    )
+        apod = {key: api_resp.json().get(key) for key in ("date", "media_type", "hdurl", "url")}
+        metadata_blob.upload_from_string(json.dumps(apod), content_type="application/json")
 
-    print(f"Saved {pic_url}")
-    return f"Saved {pic_url}"
+    apod_metadata[date] = apod
+    return apod
 
 
 # [START v2EnqueueTasks]
 @https_fn.on_request()
 def enqueuebackuptasks(_: https_fn.Request) -> https_fn.Response:
-    """Adds backup tasks to a Cloud Tasks queue."""
-    task_queue = functions.task_queue("backupapod")
+    """Adds backup tasks to a Cloud Tasks queue.
+
+    Each task backs up BACKUP_DAYS_PER_TASK consecutive days and is named after its dates,
+    so calling this function again doesn't enqueue duplicates.
+    """
+    from firebase_admin import functions
+
+    start = time.monotonic()
+    task_queue = functions.task_queue("backupapod", app=get_app())
     target_uri = get_function_url("backupapod")
+    now = datetime.now()
+    days_per_task = max(BACKUP_DAYS_PER_TASK, 1)
+    if days_per_task == 1:
+        dispatch_deadline_seconds = 60 * 5  # 5 minutes
+    else:
+        dispatch_deadline_seconds = 60 * 30  # 30 minutes, the most Cloud Tasks allows
 
-    for i in range(BACKUP_COUNT):
+    tasks = []
+    for i in range(0, BACKUP_COUNT, days_per_task):
         batch = i // HOURLY_BATCH_SIZE
 
         # Delay each batch by N hours
         schedule_delay = timedelta(hours=batch)
-        schedule_time = datetime.now() + schedule_delay
 
-        dispatch_deadline_seconds = 60 * 5  # 5 minutes
-
-        backup_date = BACKUP_START_DATE + timedelta(days=i)
-        body = {"data": {"date": backup_date.isoformat()[:10]}}
+        backup_date = (BACKUP_START_DATE + timedelta(days=i)).isoformat()[:10]
+        if days_per_task == 1:
+            body = {"data": {"date": backup_date}}
+            task_id = hashed_task_id(f"backupapod-{backup_date}")
+        else:
+            days = min(days_per_task, BACKUP_COUNT - i)
+            end_date = (BACKUP_START_DATE + timedelta(days=i + days - 1)).isoformat()[:10]
+            body = {"data": {"start_date": backup_date, "end_date": end_date}}
+            task_id = hashed_task_id(f"backupapod-{backup_date}-to-{end_date}")
         task_options = functions.TaskOptions(
-            schedule_time=schedule_time,
+            schedule_time=now + schedule_delay,
             dispatch_deadline_seconds=dispatch_deadline_seconds,
             uri=target_uri,
+            task_id=task_id,
+        )
+        tasks.append((body, task_options))
+
+    with ThreadPoolExecutor(max_workers=ENQUEUE_WORKERS) as executor:
+        outcomes = collections.Counter(
+            executor.map(lambda task: enqueue_with_retry(task_queue, *task), tasks)
         )
-        task_queue.enqueue(body, task_options)
-    return https_fn.Response(status=200, response=f"Enqueued {BACKUP_COUNT} tasks")
+    summary = {
+        "enqueued": outcomes["enqueued"],
+        "duplicate": outcomes["duplicate"],
+        "failed": outcomes["failed"],
+        "elapsed_seconds": round(time.monotonic() - start, 3),
+    }
+    print(f"Enqueued backup tasks: {summary}")
+    return https_fn.Response(json.dumps(summary), status=200, content_type="application/json")
+
+
+def hashed_task_id(name: str) -> str:
+    """Prefix a task name with a hash of itself.
+
+    Cloud Tasks spreads tasks across its backends by name. Sequential names, like ones
+    that start with consecutive dates, raise latency and error rates, so the prefix
+    spreads them out while keeping each name the same from run to run.
+    """
+    return f"{hashlib.sha1(name.encode()).hexdigest()[:8]}-{name}"
+
+
+def enqueue_with_retry(task_queue, body: dict, task_options) -> str:
+    """Enqueue a task, retrying transient errors with exponential backoff.
+
+    Returns:
+        "enqueued", "duplicate" if a task with the same name already exists, or "failed".
+    """
+    from firebase_admin import exceptions
+
+    for attempt in range(ENQUEUE_MAX_ATTEMPTS):
+        try:
+            task_queue.enqueue(body, task_options)
+            return "enqueued"
+        except exceptions.AlreadyExistsError:
+            return "duplicate"
+        except (
+            exceptions.UnavailableError,
+            exceptions.ResourceExhaustedError,
+            exceptions.DeadlineExceededError,
+            exceptions.InternalError,
+        ) as error:
+            if attempt == ENQUEUE_MAX_ATTEMPTS - 1:
+                print(f"Unable to enqueue task {task_options.task_id}.", error)
+                return "failed"
+            time.sleep(2**attempt + random.random())
+        except exceptions.FirebaseError as error:
+            print(f"Unable to enqueue task {task_options.task_id}.", error)
+            return "failed"
+    return "failed"
 # [END v2EnqueueTasks]
 
 
+# How long a resolved function URL is reused, and how long a failed lookup is remembered
+# before it's tried again.
+FUNCTION_URL_TTL_SECONDS = 60 * 60
+FUNCTION_URL_FAILURE_TTL_SECONDS = 30
+
+# (name, location) -> (expiry, URL or None if the lookup failed)
+function_urls: dict[tuple[str, str], tuple[float, str | None]] = {}
+function_urls_lock = threading.Lock()
+
+
 # [START v2GetFunctionUri]
 def get_function_url(name: str, location: str = SupportedRegion.US_CENTRAL1) -> str:
     """Get the URL of a given v2 cloud function.
 
+    URLs are cached for the life of the instance, so at most one lookup is made per
+    function per hour. To skip the lookup entirely, set the URL in a
+    `FUNCTION_URL_<NAME>` environment variable, for example in your .env file.
+
     Params:
         name: the function's name
         location: the function's location
 
     Returns: The URL of the function
     """
+    key = (name, str(location))
+    with function_urls_lock:
+        expiry, function_url = function_urls.get(key, (0.0, None))
+        if expiry <= time.monotonic():
+            function_url = os.environ.get(f"FUNCTION_URL_{name.upper()}")
+            if function_url is None:
+                function_url = lookup_function_url(name, str(location))
+            ttl = FUNCTION_URL_TTL_SECONDS if function_url else FUNCTION_URL_FAILURE_TTL_SECONDS
+            function_urls[key] = (time.monotonic() + ttl, function_url)
+    if function_url is None:
+        raise LookupError(f"Unable to find the URL of function {name} in {location}.")
+    return function_url
+
+
+@functools.cache
+def get_authorized_session():
+    """Create an authorized session on first use, then reuse its credentials and
+    connections for the life of the instance."""
+    import google.auth
+    from google.auth.transport.requests import AuthorizedSession
+
     credentials, project_id = google.auth.default(
         scopes=["https://www.googleapis.com/auth/cloud-platform"]
     )
-    authed_session = AuthorizedSession(credentials)
+    return AuthorizedSession(credentials), project_id
+
+
+def lookup_function_url(name: str, location: str) -> str | None:
+    """Look up the URL of a v2 cloud function with the Cloud Functions API."""
+    authed_session, project_id = get_authorized_session()
     url = (
         "https://cloudfunctions.googleapis.com/v2beta/"
         + f"projects/{project_id}/locations/{location}/functions/{name}"
     )
-    response = authed_session.get(url)
-    data = response.json()
-    function_url = data["serviceConfig"]["uri"]
-    return function_url
+    try:
+        response = authed_session.get(url, timeout=10)
+        response.raise_for_status()
+        return response.json()["serviceConfig"]["uri"]
+    except Exception as error:
+        print(f"Unable to look up the URL of function {name}.", error)
+        return None
 # [END v2GetFunctionUri]
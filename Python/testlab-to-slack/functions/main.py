@@ -15,21 +15,27 @@
 # [START all]
 # [START import]
 # The Cloud Functions for Firebase SDK to set up triggers and logging.
-from firebase_functions import test_lab_fn, params
+from firebase_functions import test_lab_fn, params, logger
 
-# The requests library to send web requests to Slack.
+# The requests library and a webhook client that keeps connections to Slack alive,
+# times out and retries.
 import requests
+import webhook
 # [END import]
 
 # [START postToSlack]
 SLACK_WEBHOOK_URL = params.SecretParam("SLACK_WEBHOOK_URL")
 
+# Log Slack's response bodies at debug severity, truncated to RESPONSE_MAX_CHARS.
+LOG_SLACK_RESPONSES = params.BoolParam("LOG_SLACK_RESPONSES", default=False)
+RESPONSE_MAX_CHARS = 500
+
 
 def post_to_slack(title: str, details: str) -> requests.Response:
     """Posts a message to Slack via a Webhook."""
-    return requests.post(
+    return webhook.post(
         SLACK_WEBHOOK_URL.value,
-        json={
+        {
             "blocks": [
                 {"type": "section", "text": {"type": "mrkdwn", "text": title}},
                 {"type": "divider"},
@@ -83,6 +89,12 @@ def posttestresultstoslack(
     response = post_to_slack(title, details)
 
     # Log the response
-    print(response.status_code, response.text)
+    print(f"Slack responded {response.status_code} for test matrix {test_matrix_id}")
+    if LOG_SLACK_RESPONSES.value:
+        logger.debug(
+            "Slack response",
+            status=response.status_code,
+            body=response.text[:RESPONSE_MAX_CHARS],
+        )
 # [END posttestresultstoslack]
 # [END all]
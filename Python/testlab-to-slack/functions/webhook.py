@@ -0,0 +1,166 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Posts JSON to chat webhooks such as Discord's and Slack's.
+
+Connections are kept alive between invocations, requests time out instead of holding
+the function until its deadline, and failed posts are retried, waiting as long as the
+webhook's rate limit asks. This file is the same in the alerts-to-discord and
+testlab-to-slack samples.
+"""
+
+import functools
+import random
+import threading
+import time
+from urllib.parse import urlparse
+
+import requests
+import requests.adapters
+import urllib3.exceptions
+
+# (connect, read) timeouts in seconds.
+TIMEOUT = (3.05, 10)
+
+MAX_ATTEMPTS = 4
+
+# Give up instead of waiting longer than this for a rate limit to reset, so a post
+# doesn't hold the function until its deadline.
+MAX_RETRY_AFTER_SECONDS = 30
+
+# Don't start a retry that could still be running this many seconds after the post began,
+# so a post finishes within the function's 60 second timeout.
+DEADLINE_SECONDS = 50
+
+# url -> time.monotonic() before which the webhook's rate limit says not to post.
+rate_limited_until: dict[str, float] = {}
+rate_limited_until_lock = threading.Lock()
+
+
+@functools.cache
+def get_session(host: str) -> requests.Session:
+    """Create a session for a webhook host on first use, then keep its connections alive
+    for the life of the instance."""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=10)
+    session.mount(f"https://{host}", adapter)
+    session.mount(f"http://{host}", adapter)
+    return session
+
+
+def post(url: str, payload: dict, deadline_seconds: float = DEADLINE_SECONDS) -> requests.Response:
+    """Post a JSON payload to a webhook.
+
+    Retries connections that failed before the request was sent, 429 responses and 5xx
+    responses with exponential backoff, or after the delay a 429 response asks for. Posts
+    whose response wasn't received aren't retried, because the webhook might have posted
+    the message already. Neither are posts whose retry could run past `deadline_seconds`
+    after this call.
+
+    Returns:
+        The last response, which callers should check like any other.
+
+    Raises:
+        requests.RequestException: If the webhook couldn't be reached or timed out.
+    """
+    session = get_session(urlparse(url).netloc)
+    deadline = time.monotonic() + deadline_seconds
+    for attempt in range(MAX_ATTEMPTS):
+        wait = rate_limit_wait(url)
+        if wait > 0:
+            time.sleep(wait)
+
+        try:
+            response = session.post(url, json=payload, timeout=TIMEOUT)
+        except requests.ConnectionError as error:
+            delay = 2**attempt + random.random()
+            if (
+                attempt == MAX_ATTEMPTS - 1
+                or not failed_before_sending(error)
+                or not can_retry(deadline, delay)
+            ):
+                raise
+            time.sleep(delay)
+            continue
+        remember_rate_limit(url, response)
+
+        if attempt == MAX_ATTEMPTS - 1:
+            return response
+        if response.status_code == 429:
+            delay = retry_after(response)
+            if delay is None:
+                delay = 2**attempt + random.random()
+            elif delay > MAX_RETRY_AFTER_SECONDS:
+                return response
+        elif response.status_code >= 500:
+            delay = 2**attempt + random.random()
+        else:
+            return response
+        if not can_retry(deadline, max(delay, rate_limit_wait(url))):
+            return response
+        print(f"Webhook responded {response.status_code}. Retrying in {delay:.1f}s.")
+        time.sleep(delay)
+    return response
+
+
+def failed_before_sending(error: requests.ConnectionError) -> bool:
+    """Whether a connection error happened before the request was sent, such as a connect
+    timeout or a refused connection, rather than a connection reset after it."""
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = error.args[0] if error.args else None
+    if isinstance(reason, urllib3.exceptions.MaxRetryError):
+        reason = reason.reason
+    return isinstance(reason, urllib3.exceptions.NewConnectionError)
+
+
+def can_retry(deadline: float, delay: float) -> bool:
+    """Whether a retry after `delay` seconds would finish by `deadline`, even if it times
+    out."""
+    return time.monotonic() + delay + sum(TIMEOUT) <= deadline
+
+
+def rate_limit_wait(url: str) -> float:
+    """How many seconds to wait before posting to a webhook, going by its rate limit."""
+    with rate_limited_until_lock:
+        return rate_limited_until.get(url, 0) - time.monotonic()
+
+
+def retry_after(response: requests.Response) -> float | None:
+    """How many seconds a 429 response asks to wait before trying again, if it says.
+
+    Discord puts `retry_after` in the JSON body. Slack and others send a
+    `Retry-After` header.
+    """
+    try:
+        return float(response.json()["retry_after"])
+    except (ValueError, KeyError, TypeError):
+        pass
+    try:
+        return float(response.headers["Retry-After"])
+    except (ValueError, KeyError):
+        return None
+
+
+def remember_rate_limit(url: str, response: requests.Response) -> None:
+    """Hold later posts to a webhook until its rate limit resets, if Discord's rate limit
+    headers say there are no requests left."""
+    if response.headers.get("X-RateLimit-Remaining") != "0":
+        return
+    try:
+        reset_after = float(response.headers["X-RateLimit-Reset-After"])
+    except (ValueError, KeyError):
+        return
+    with rate_limited_until_lock:
+        rate_limited_until[url] = time.monotonic() + min(reset_after, MAX_RETRY_AFTER_SECONDS)
@@ -0,0 +1,131 @@
+"""Utility to measure the peak memory the thumbnails sample takes to generate thumbnails
+for images of increasing size, against a local fake bucket."""
+
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import pathlib
+import subprocess
+import sys
+import tempfile
+
+# Generates the thumbnails in a fresh interpreter, so each size starts from the same peak.
+# The bucket reads the original from a local file and discards the thumbnails.
+thumbnail_runner = """
+import os, pathlib, resource, shutil, sys
+sys.path.insert(0, sys.argv[1])
+import main
+from PIL import Image
+
+class Blob:
+    def __init__(self, name, chunk_size=None, generation=None):
+        self.name = name
+        self.metadata = None
+
+    def download_to_file(self, file):
+        with open(self.name, "rb") as original:
+            shutil.copyfileobj(original, file)
+
+    def open(self, mode, content_type=None):
+        return open(os.devnull, "wb")
+
+class Bucket:
+    def blob(self, name, chunk_size=None, generation=None):
+        return Blob(name, chunk_size, generation)
+
+before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+generated = main.generate_thumbnails(Bucket(), pathlib.PurePath(sys.argv[2]), 1, "md5")
+after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(before, after, generated)
+"""
+
+# The function decorators need a project config to import outside of the emulator.
+demo_firebase_config = (
+    '{"projectId": "demo-thumbnailbench", "storageBucket": "demo-thumbnailbench.appspot.com"}'
+)
+
+
+# Saves a noisy 4:3 image, which compresses about as badly as a photo. This also runs in
+# its own interpreter, because on Linux a child process starts with its parent's peak RSS.
+image_maker = """
+import sys
+from PIL import Image
+
+width = int(sys.argv[2])
+size = (width, width * 3 // 4)
+bands = [Image.effect_noise(size, sigma) for sigma in (40, 60, 80)]
+Image.merge("RGB", bands).save(sys.argv[1], format=sys.argv[3])
+"""
+
+
+def make_image(path: pathlib.Path, width: int, image_format: str) -> None:
+    subprocess.run(
+        [sys.executable, "-c", image_maker, str(path), str(width), image_format], check=True
+    )
+
+
+def measure_peak_rss(functions_dir: str, image_path: pathlib.Path) -> tuple[int, int, bool]:
+    """Generate thumbnails for an image in a fresh interpreter.
+
+    Returns:
+        The peak RSS in KiB after importing main.py and after generating the thumbnails,
+        and whether thumbnails were generated.
+    """
+    env = {"FIREBASE_CONFIG": demo_firebase_config, "GCLOUD_PROJECT": "demo-thumbnailbench"}
+    env.update(os.environ)
+    result = subprocess.run(
+        [sys.executable, "-c", thumbnail_runner, functions_dir, str(image_path)],
+        capture_output=True,
+        env=env,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.decode("utf-8").strip().splitlines()[-1])
+    before, after, generated = result.stdout.decode("utf-8").split()[-3:]
+    return int(before), int(after), generated == "True"
+
+
+if __name__ == "__main__":
+    import argparse
+
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument(
+        "--widths",
+        "-w",
+        type=int,
+        nargs="+",
+        default=[1000, 2000, 4000, 8000],
+        help="widths in pixels of the 4:3 images to generate thumbnails for",
+    )
+    argparser.add_argument(
+        "--format", "-f", default="jpeg", help="format of the images, such as jpeg or png"
+    )
+    argparser.add_argument(
+        "functions_dir",
+        nargs="?",
+        default="thumbnails/functions",
+        help="the functions directory whose main.py to benchmark",
+    )
+    args = argparser.parse_args()
+
+    with tempfile.TemporaryDirectory() as images_dir:
+        for width in args.widths:
+            image_path = pathlib.Path(images_dir) / f"{width}.{args.format}"
+            make_image(image_path, width, args.format)
+            before, after, generated = measure_peak_rss(args.functions_dir, image_path)
+            print(
+                f"{width:>6}x{width * 3 // 4:<6} {image_path.stat().st_size / 2**20:7.1f} MiB:"
+                f" peak RSS {after / 1024:7.1f} MiB, {(after - before) / 1024:7.1f} MiB over"
+                f" import{'' if generated else ' (too large to decode)'}"
+            )
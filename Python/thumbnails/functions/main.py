@@ -14,22 +14,73 @@
 
 # [START storageImports]
 # [START storageAdditionalImports]
-import io
+import collections
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import functools
+import itertools
+import json
+import multiprocessing
+import os
 import pathlib
+import tempfile
+import threading
+import time
+from typing import TYPE_CHECKING, NamedTuple
 
-from PIL import Image
+import firebase_admin
 
-from firebase_admin import initialize_app
-
-initialize_app()
-from firebase_admin import storage
+# Pillow and the Cloud Storage client are imported on first use, so invocations that
+# exit early (such as for uploads that aren't images) don't pay for them on cold start.
+if TYPE_CHECKING:
+    from PIL import Image
 # [END storageAdditionalImports]
 
 # [START storageSDKImport]
-from firebase_functions import storage_fn
+from firebase_functions import options, params, storage_fn, tasks_fn
 # [END storageSDKImport]
 # [END storageImports]
 
+# Comma-separated renditions to generate for each upload, as `size:format[:quality]`.
+# Every rendition is scaled down from a single decode of the original.
+RENDITIONS = params.StringParam("THUMBNAIL_RENDITIONS", default="800:jpeg:85,200:png,64:webp:80")
+
+# Originals up to this size are buffered in memory while they download. Anything
+# larger is spooled to a temporary file instead.
+SPOOL_MAX_BYTES = 16 * 1024 * 1024
+
+# Originals and thumbnails are streamed to and from Cloud Storage in chunks of this
+# size. Must be a multiple of 256 KiB.
+CHUNK_SIZE_BYTES = 4 * 1024 * 1024
+
+# The most memory a single decoded image may use. Larger images are skipped instead of
+# running the instance out of memory.
+MAX_DECODE_MB = params.IntParam("THUMBNAIL_MAX_DECODE_MB", default=256)
+
+
+@functools.cache
+def get_app() -> firebase_admin.App:
+    """Initialize the Admin SDK on first use, then reuse it for the life of the instance."""
+    return firebase_admin.initialize_app()
+
+
+def get_bucket(name: str | None = None, app: firebase_admin.App | None = None):
+    """Get a Cloud Storage bucket, importing the storage client on first use.
+
+    If STORAGE_EMULATOR_HOST is set, the bucket is on that emulator or fake GCS server
+    instead, which the storage client reaches without credentials.
+    """
+    app = app if app is not None else get_app()
+    if "STORAGE_EMULATOR_HOST" in os.environ:
+        from google.auth.credentials import AnonymousCredentials
+        from google.cloud import storage
+
+        client = storage.Client(project=app.project_id, credentials=AnonymousCredentials())
+        return client.bucket(name or app.options.get("storageBucket"))
+
+    from firebase_admin import storage
+
+    return storage.bucket(name, app=app)
+
 
 # [START storageGenerateThumbnail]
 # [START storageGenerateThumbnailTrigger]
@@ -55,20 +106,345 @@ def generatethumbnail(event: storage_fn.CloudEvent[storage_fn.StorageObjectData]
     if file_path.name.startswith("thumb_"):
         print("Already a thumbnail.")
         return
+
+    # Exit if the image is one of our own thumbnails that was uploaded under another name.
+    if event.data.metadata is not None and "source_generation" in event.data.metadata:
+        print("Already a thumbnail.")
+        return
     # [END storageStopConditions]
 
+    # Exit if this exact version of the image already has thumbnails, for example when the
+    # event is a retry or a duplicate delivery.
+    bucket = get_bucket(bucket_name)
+    key = IdempotencyKey(bucket_name, event.data.name, event.data.generation, event.data.md5_hash)
+    if already_thumbnailed(bucket, key):
+        print(f"Thumbnails are up to date. {dict(idempotency_stats)}")
+        return
+
+    if generate_thumbnails(bucket, file_path, event.data.generation, event.data.md5_hash):
+        print(f"Generated thumbnails. {dict(idempotency_stats)}")
+    remember_thumbnailed(key)
+# [END storageGenerateThumbnail]
+
+
+def generate_thumbnails(
+    bucket, file_path: pathlib.PurePath, generation: int | None, md5_hash: str | None
+) -> bool:
+    """Generate every configured rendition of an image from a single decode.
+
+    Each thumbnail records the generation and MD5 hash of the original and the rendition
+    spec it was made with in its custom metadata, so it can later be recognized as up to
+    date.
+
+    Returns:
+        True if thumbnails were uploaded, False if the image was too large to decode.
+    """
+    from PIL import Image
+
+    spec = RENDITIONS.value
+    renditions = parse_renditions(spec)
+    largest = renditions[0].size
+
     # [START storageThumbnailGeneration]
-    bucket = storage.bucket(bucket_name)
-
-    image_blob = bucket.blob(str(file_path))
-    image_bytes = image_blob.download_as_bytes()
-    image = Image.open(io.BytesIO(image_bytes))
-
-    image.thumbnail((200, 200))
-    thumbnail_io = io.BytesIO()
-    image.save(thumbnail_io, format="png")
-    thumbnail_path = file_path.parent / pathlib.PurePath(f"thumb_{file_path.stem}.png")
-    thumbnail_blob = bucket.blob(str(thumbnail_path))
-    thumbnail_blob.upload_from_string(thumbnail_io.getvalue(), content_type="image/png")
+    image_blob = bucket.blob(str(file_path), chunk_size=CHUNK_SIZE_BYTES, generation=generation)
+    with tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES) as original:
+        image_blob.download_to_file(original)
+        original.seek(0)
+        image = Image.open(original)
+
+        # Only decode the original at the scale needed for the largest rendition. For
+        # JPEGs this lets the decoder skip up to 63 of every 64 pixels.
+        image.draft(None, (largest * 2, largest * 2))
+        if image.width * image.height * len(image.getbands()) > MAX_DECODE_MB.value * 2**20:
+            print(f"Image is too large to decode. ({image.width}x{image.height})")
+            return False
+        image.load()
+
+    # Scale each rendition down from the previous, larger one instead of from the original.
+    scaled = []
+    for rendition in renditions:
+        image = image.copy() if scaled else image
+        image.thumbnail((rendition.size, rendition.size))
+        scaled.append((rendition, image))
+
+    metadata = {
+        "source_generation": str(generation),
+        "source_md5": str(md5_hash),
+        "renditions": spec,
+    }
+
+    # Encode and upload the renditions in parallel. Pillow releases the GIL while encoding.
+    # The smallest goes last, once the others are uploaded, so its metadata marks the whole
+    # set as done.
+    *others, (marker, marker_image) = scaled
+    with ThreadPoolExecutor(max_workers=max(len(others), 1)) as executor:
+        futures = [
+            executor.submit(upload_rendition, bucket, file_path, rendition, scaled_image, metadata)
+            for rendition, scaled_image in others
+        ]
+        for future in futures:
+            future.result()
+    upload_rendition(bucket, file_path, marker, marker_image, metadata)
     # [END storageThumbnailGeneration]
-# [END storageGenerateThumbnail]
+    return True
+
+
+class Rendition(NamedTuple):
+    """A thumbnail size and the format to encode it in."""
+
+    size: int
+    format: str
+    quality: int | None = None
+
+
+CONTENT_TYPES = {
+    "avif": "image/avif",
+    "jpeg": "image/jpeg",
+    "png": "image/png",
+    "webp": "image/webp",
+}
+
+
+@functools.cache
+def avif_supported() -> bool:
+    """Whether this build of Pillow can encode AVIF. Imports Pillow, so it's only called
+    for specs that ask for AVIF."""
+    from PIL import features
+
+    return features.check("avif")
+
+
+def parse_renditions(spec: str) -> list[Rendition]:
+    """Parse a rendition spec such as `800:jpeg:85,200:png` into renditions, largest first.
+
+    AVIF renditions fall back to WebP if this build of Pillow can't encode AVIF.
+    """
+    renditions = []
+    for item in spec.split(","):
+        size, image_format, *quality = item.strip().split(":")
+        image_format = image_format.lower()
+        if image_format == "jpg":
+            image_format = "jpeg"
+        if image_format == "avif" and not avif_supported():
+            image_format = "webp"
+        if image_format not in CONTENT_TYPES:
+            raise ValueError(f"Unsupported thumbnail format: {image_format}")
+        renditions.append(Rendition(int(size), image_format, int(quality[0]) if quality else None))
+    return sorted(renditions, key=lambda rendition: rendition.size, reverse=True)
+
+
+def rendition_path(file_path: pathlib.PurePath, rendition: Rendition) -> pathlib.PurePath:
+    """The path of a rendition: `thumb_<name>_<size>.<ext>` next to the original."""
+    extension = "jpg" if rendition.format == "jpeg" else rendition.format
+    return file_path.parent / f"thumb_{file_path.stem}_{rendition.size}.{extension}"
+
+
+def upload_rendition(
+    bucket,
+    file_path: pathlib.PurePath,
+    rendition: Rendition,
+    image: "Image.Image",
+    metadata: dict[str, str],
+) -> None:
+    """Encode a scaled image and stream it to Cloud Storage next to the original."""
+    if rendition.format == "jpeg" and image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+    thumbnail_path = rendition_path(file_path, rendition)
+    thumbnail_blob = bucket.blob(str(thumbnail_path), chunk_size=CHUNK_SIZE_BYTES)
+    thumbnail_blob.metadata = metadata
+    save_options = {} if rendition.quality is None else {"quality": rendition.quality}
+    # Pillow flushes the file when it's done encoding, which a blob writer can only do by
+    # finishing the upload, so the flush is left to the close at the end of the block.
+    with thumbnail_blob.open(
+        "wb", ignore_flush=True, content_type=CONTENT_TYPES[rendition.format]
+    ) as thumbnail_file:
+        image.save(thumbnail_file, format=rendition.format, **save_options)
+
+
+def thumbnails_are_current(
+    bucket, file_path: pathlib.PurePath, generation: int | None, md5_hash: str | None
+) -> bool:
+    """Check whether an image already has thumbnails made from this version of it with
+    the current rendition spec. Only reads the metadata of the smallest rendition, which
+    generate_thumbnails uploads after all the others."""
+    spec = RENDITIONS.value
+    expected = {
+        "source_generation": str(generation),
+        "source_md5": str(md5_hash),
+        "renditions": spec,
+    }
+    marker = parse_renditions(spec)[-1]
+    thumbnail_blob = bucket.get_blob(str(rendition_path(file_path, marker)))
+    if thumbnail_blob is None or thumbnail_blob.metadata is None:
+        return False
+    return all(thumbnail_blob.metadata.get(k) == v for k, v in expected.items())
+
+
+class IdempotencyKey(NamedTuple):
+    """Identifies one version of an uploaded image."""
+
+    bucket: str
+    name: str
+    generation: int | None
+    md5_hash: str | None
+
+
+# How many recently thumbnailed images each instance remembers.
+RECENT_KEYS_MAX = 10_000
+
+recent_keys: collections.OrderedDict[IdempotencyKey, None] = collections.OrderedDict()
+recent_keys_lock = threading.Lock()
+
+# Counts of duplicate events caught in memory ("memory_hits") or by the thumbnails'
+# metadata ("marker_hits"), and of events that needed new thumbnails ("misses").
+idempotency_stats: collections.Counter[str] = collections.Counter()
+
+
+def already_thumbnailed(bucket, key: IdempotencyKey) -> bool:
+    """Check whether thumbnails for this version of an image were already generated.
+
+    Checks this instance's memory first, then the metadata on the existing thumbnails.
+    Neither check downloads the image.
+    """
+    with recent_keys_lock:
+        if key in recent_keys:
+            recent_keys.move_to_end(key)
+            idempotency_stats["memory_hits"] += 1
+            return True
+    if thumbnails_are_current(bucket, pathlib.PurePath(key.name), key.generation, key.md5_hash):
+        idempotency_stats["marker_hits"] += 1
+        remember_thumbnailed(key)
+        return True
+    idempotency_stats["misses"] += 1
+    return False
+
+
+def remember_thumbnailed(key: IdempotencyKey) -> None:
+    """Remember that thumbnails were generated for this version of an image."""
+    with recent_keys_lock:
+        recent_keys[key] = None
+        recent_keys.move_to_end(key)
+        while len(recent_keys) > RECENT_KEYS_MAX:
+            recent_keys.popitem(last=False)
+
+
+# Number of objects to list from the bucket at a time. Progress is checkpointed after
+# each page.
+BACKFILL_PAGE_SIZE = 1000
+
+# Stop starting new pages after this long, so the checkpoint is saved before the task's
+# 30 minute dispatch deadline.
+BACKFILL_TIME_BUDGET_SECONDS = 25 * 60
+
+
+@tasks_fn.on_task_dispatched(timeout_sec=1800, memory=options.MemoryOption.GB_8, cpu=4)
+def backfillthumbnails(req: tasks_fn.CallableRequest) -> dict:
+    """Generate thumbnails for images that are already in a bucket, for example after
+    changing THUMBNAIL_RENDITIONS.
+
+    Lists the objects under the task's `prefix` in the default bucket (or `bucket`) a
+    page at a time, and spreads the images that don't have up-to-date thumbnails across
+    a process pool. Progress is checkpointed after every page, so enqueuing the task
+    again resumes an interrupted run.
+
+    If the run stops for its time budget before the last page, it enqueues a task to
+    continue from the checkpoint. If that fails, the task fails too, so Cloud Tasks
+    retries it and the retry resumes from the same checkpoint.
+
+    This is a task queue function, so only callers allowed to enqueue tasks, such as
+    the Admin SDK's `functions.task_queue("backfillthumbnails").enqueue(...)`, can
+    start a backfill. Enqueue it with a 30 minute `dispatch_deadline_seconds`.
+
+    To try it locally, set STORAGE_EMULATOR_HOST to a fake GCS server, such as the one
+    backfillbench.py runs.
+    """
+    bucket = get_bucket(req.data.get("bucket"))
+    prefix = req.data.get("prefix", "")
+
+    checkpoint_blob = bucket.blob(f"thumbnail_backfill/{prefix.replace('/', '_') or '_all'}.json")
+    checkpoint = {}
+    if (saved_checkpoint := bucket.get_blob(checkpoint_blob.name)) is not None:
+        checkpoint = json.loads(saved_checkpoint.download_as_text())
+    if checkpoint.get("done", False):
+        # The last run finished, so start over from the beginning.
+        checkpoint = {}
+    counts = checkpoint.get("counts", {"generated": 0, "skipped": 0, "failed": 0})
+
+    blobs = bucket.list_blobs(
+        prefix=prefix,
+        page_token=checkpoint.get("page_token"),
+        page_size=BACKFILL_PAGE_SIZE,
+        fields="items(name,generation,md5Hash,contentType),nextPageToken",
+    )
+    deadline = time.monotonic() + BACKFILL_TIME_BUDGET_SECONDS
+    done = False
+    # Start the workers fresh rather than forking this process, whose Admin SDK app,
+    # HTTP connections and server threads aren't safe to copy.
+    with ProcessPoolExecutor(
+        mp_context=multiprocessing.get_context("spawn"), initializer=init_backfill_worker
+    ) as executor:
+        for page in blobs.pages:
+            images = [
+                blob
+                for blob in page
+                if blob.content_type is not None
+                and blob.content_type.startswith("image/")
+                and not pathlib.PurePath(blob.name).name.startswith("thumb_")
+            ]
+            results = executor.map(
+                backfill_image,
+                itertools.repeat(bucket.name),
+                [blob.name for blob in images],
+                [blob.generation for blob in images],
+                [blob.md5_hash for blob in images],
+                chunksize=8,
+            )
+            for result in results:
+                counts[result] += 1
+
+            done = blobs.next_page_token is None
+            checkpoint_blob.upload_from_string(
+                json.dumps({"page_token": blobs.next_page_token, "done": done, "counts": counts}),
+                content_type="application/json",
+            )
+            if time.monotonic() > deadline:
+                break
+
+    if not done:
+        enqueue_backfill_continuation(req.data)
+    print(f"Backfilled thumbnails under {prefix!r}: {counts}")
+    return {"done": done, **counts}
+
+
+def enqueue_backfill_continuation(data: dict) -> None:
+    """Enqueue a backfill task that picks up from the checkpoint just saved."""
+    from firebase_admin import functions
+
+    task_options = functions.TaskOptions(dispatch_deadline_seconds=1800)
+    task_id = functions.task_queue("backfillthumbnails", app=get_app()).enqueue(data, task_options)
+    print(f"Enqueued task {task_id} to continue the backfill.")
+
+
+def init_backfill_worker() -> None:
+    """Give each worker process its own Admin SDK app."""
+    global backfill_app
+    backfill_app = firebase_admin.initialize_app(name="backfill")
+
+
+def backfill_image(bucket_name: str, name: str, generation: int, md5_hash: str | None) -> str:
+    """Generate thumbnails for one image in a worker process, unless they're up to date.
+
+    Returns:
+        "generated", "skipped", or "failed".
+    """
+    bucket = get_bucket(bucket_name, app=backfill_app)
+    file_path = pathlib.PurePath(name)
+    try:
+        if thumbnails_are_current(bucket, file_path, generation, md5_hash):
+            return "skipped"
+        if generate_thumbnails(bucket, file_path, generation, md5_hash):
+            return "generated"
+        return "skipped"
+    except Exception as error:
+        print(f"Unable to generate thumbnails for {name}.", error)
+        return "failed"
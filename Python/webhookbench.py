@@ -0,0 +1,91 @@
+"""Utility to compare webhook post latency with and without the webhook client, against a
+local mock webhook."""
+
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import http.server
+import statistics
+import sys
+import threading
+import time
+
+
+class MockWebhook(http.server.BaseHTTPRequestHandler):
+    """Accepts posts like Discord and Slack do, on a kept-alive connection."""
+
+    protocol_version = "HTTP/1.1"
+    # Seconds to wait before responding, to simulate the webhook's processing time.
+    delay = 0.0
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        time.sleep(self.delay)
+        self.send_response(204)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def time_posts(post, url: str, posts: int) -> list[float]:
+    payload = {"username": "Benchmark Bot", "content": "Hello from webhookbench.py"}
+    times = []
+    for _ in range(posts):
+        start = time.perf_counter()
+        post(url, payload).raise_for_status()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def summarize(times: list[float]) -> str:
+    p50, p99 = (statistics.quantiles(times, n=100)[i] for i in (49, 98))
+    return f"p50 {p50 * 1000:7.2f} ms, p99 {p99 * 1000:7.2f} ms"
+
+
+if __name__ == "__main__":
+    import argparse
+
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument(
+        "--posts", "-n", type=int, default=500, help="number of posts to time per client"
+    )
+    argparser.add_argument(
+        "--delay", type=float, default=0.0, help="seconds the mock webhook takes to respond"
+    )
+    argparser.add_argument(
+        "functions_dir",
+        nargs="?",
+        default="alerts-to-discord/functions",
+        help="the functions directory whose webhook.py to benchmark",
+    )
+    args = argparser.parse_args()
+
+    sys.path.insert(0, args.functions_dir)
+    import requests
+    import webhook
+
+    MockWebhook.delay = args.delay
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), MockWebhook)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/webhook"
+
+    clients = [
+        ("requests.post", lambda url, payload: requests.post(url, json=payload)),
+        ("webhook.post", webhook.post),
+    ]
+    for label, post in clients:
+        print(f"{label:>14}: {summarize(time_posts(post, url, args.posts))}")
+    server.shutdown()